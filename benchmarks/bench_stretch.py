@@ -0,0 +1,312 @@
+"""
+Microbenchmarks of the stretching kernels and of the api loaders.
+
+The kernels run on synthetic correlation functions
+(:mod:`ms_stretch.synthetic`), the loaders on a STR tree generated in a
+temporary folder, so no MSNoise project is needed. Every run appends one
+JSON line to a history file, with the commit it was run on, so that
+timings can be compared between commits:
+
+    python benchmarks/bench_stretch.py run --samples 6001 --nstr 1001
+    python benchmarks/bench_stretch.py compare
+
+The ``validate`` command checks the accuracy of the stretching modes on
+days with a known stretching (see
+:func:`ms_stretch.synthetic.validate_modes`).
+"""
+
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import timeit
+
+import click
+import numpy as np
+import pandas as pd
+
+from ms_stretch import api
+from ms_stretch.cache import StretchCache
+from ms_stretch.results import merge_csv, write_matrix
+from ms_stretch.stretch import correlation_matrix, hierarchical_search, \
+    normalize_traces, peak_width_error, stretch_mat_creation, \
+    theoretical_error
+from ms_stretch.synthetic import STRETCH_MODES, stretched_days, \
+    synthetic_reference, validate_modes
+
+HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       "history.jsonl")
+
+
+def generate_tree(root, npairs, ndays, nstr, str_range=0.01, mov_stack=10,
+                  filterid="01_10_30", comps=("ZZ", ), nforcings=4,
+                  seed=0):
+    """
+    Write a synthetic STR tree: one CSV per pair and component in ``STR``,
+    one npy coefficient matrix per pair and component in ``STR_Mat`` and
+    ``nforcings`` hourly forcing files in ``forcing``.
+
+    Input:
+        :type root: str
+        :param root: Folder of the tree.
+
+        :type npairs: int
+        :param npairs: Number of pairs.
+
+        :type ndays: int
+        :param ndays: Number of days of every pair.
+
+        :type nstr: int
+        :param nstr: Number of stretching steps of the matrices.
+
+    Output:
+        :type pairs: list of str
+        :param pairs: Names of the pairs (e.g. ``XX_S000_XX_S001``).
+    """
+
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range("2020-01-01", periods=ndays, name="Date")
+    deltas = 1 + np.linspace(-str_range, str_range, nstr)
+    pairs = ["XX_S%03i_XX_S%03i" % (i, i + 1) for i in range(npairs)]
+    for comp in comps:
+        str_dir = os.path.join(root, "STR", filterid, "%03i_DAYS" % mov_stack,
+                               comp)
+        mat_dir = os.path.join(root, "STR_Mat", filterid,
+                               "%03i_DAYS" % mov_stack, comp)
+        os.makedirs(str_dir)
+        os.makedirs(mat_dir)
+        for pair in pairs:
+            dvv = 1 + np.cumsum(rng.normal(0, 2e-4, ndays))
+            coeffs = np.exp(-((deltas[np.newaxis, :] - dvv[:, np.newaxis]) /
+                              (5 * str_range)) ** 2)
+            df = pd.DataFrame({"Delta": dvv, "Coeff": coeffs.max(axis=1),
+                               "Error": 1e-4, "TheoError": 1e-4},
+                              index=dates)
+            merge_csv(os.path.join(str_dir, pair + ".csv"), df)
+            write_matrix(os.path.join(mat_dir, pair), dates.values, coeffs,
+                         deltas)
+
+    forcing = os.path.join(root, "forcing")
+    os.makedirs(forcing)
+    hours = pd.date_range(dates[0], periods=24 * ndays, freq="h")
+    for i in range(nforcings):
+        pd.DataFrame({"Value": rng.normal(size=len(hours))},
+                     index=pd.Index(hours.normalize(), name="Date")).\
+            to_csv(os.path.join(forcing, "STA%02i.csv" % i))
+    return pairs
+
+
+def time_call(func, repeat):
+    """Minimum and median wall clock time (s) of ``repeat`` calls."""
+    func()  # Warm up caches and lazy imports
+    times = timeit.Timer(func).repeat(repeat=repeat, number=1)
+    return {"min": min(times), "median": float(np.median(times)),
+            "repeat": repeat}
+
+
+def kernel_benchmarks(samples, nstr, ndays, str_range=0.01):
+    """Benchmarks of the stretching kernels, as ``{name: callable}``."""
+
+    ref = synthetic_reference(samples)
+    rng = np.random.default_rng(1)
+    days = stretched_days(ref, rng.uniform(-0.8, 0.8, ndays) * str_range,
+                          noise=0.2)
+    deltas = 1 + np.linspace(-str_range, str_range, nstr)
+    ref_norm = normalize_traces(stretch_mat_creation(ref, str_range,
+                                                     nstr)[0])
+    ref_norm32 = normalize_traces(stretch_mat_creation(
+        ref, str_range, nstr, dtype=np.float32)[0], dtype=np.float32)
+
+    def correlate_and_fit(ref_norm):
+        coeffs = correlation_matrix(days, ref_norm)
+        imax = np.argmax(coeffs, axis=1)
+        best = coeffs[np.arange(ndays), imax]
+        peak_width_error(coeffs, 2 * str_range / (nstr - 1))
+        theoretical_error(best, 0.1, 1., 10., 30.)
+        return deltas[imax]
+
+    # Filled by the warm up call, so that the timed searches take their
+    # coarse and fine stretched references from it, as for the next
+    # mov_stack of a pair
+    cache = StretchCache()
+
+    return {
+        "stretch_mat_creation":
+            lambda: stretch_mat_creation(ref, str_range, nstr),
+        "stretch_mat_creation_float32":
+            lambda: stretch_mat_creation(ref, str_range, nstr,
+                                         dtype=np.float32),
+        "correlate_and_fit": lambda: correlate_and_fit(ref_norm),
+        "correlate_and_fit_float32": lambda: correlate_and_fit(ref_norm32),
+        "hierarchical_search":
+            lambda: hierarchical_search(days, ref, str_range=str_range),
+        "hierarchical_search_cached":
+            lambda: hierarchical_search(days, ref, str_range=str_range,
+                                        cache=cache),
+    }
+
+
+def loader_benchmarks(pairs, mov_stack=10, filterid="01_10_30"):
+    """
+    Benchmarks of the api loaders, as ``{name: callable}``. They must be
+    called from the root of the tree of :func:`generate_tree`.
+    """
+
+    return {
+        "get_dvv": lambda: api.get_dvv(mov_stack, ["ZZ"], filterid),
+        "get_dvv_pair": lambda: api.get_dvv(mov_stack, ["ZZ"], filterid,
+                                            pairs[0]),
+        "get_dvv_mat": lambda: api.get_dvv_mat(mov_stack, "ZZ", filterid),
+        "get_data": lambda: api.get_data("forcing", ["all"]),
+    }
+
+
+def git_commit():
+    """Current commit of the repository and whether it has local changes."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=root,
+            stderr=subprocess.DEVNULL).decode().strip()
+        dirty = bool(subprocess.check_output(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=root, stderr=subprocess.DEVNULL).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+@click.group()
+def cli():
+    """Benchmarks of ms_stretch."""
+    pass
+
+
+@cli.command()
+@click.option('--samples', default=6001, help='Samples of the synthetic '
+              'correlation functions.')
+@click.option('--nstr', default=1001, help='Number of stretching steps.')
+@click.option('--days', default=365, help='Number of days.')
+@click.option('--pairs', default=20, help='Number of pairs of the '
+              'generated STR tree.')
+@click.option('--repeat', default=5, help='Timed calls per benchmark.')
+@click.option('--select', default=None, help='Only run the benchmarks '
+              'whose name contains this string.')
+@click.option('--history', default=HISTORY, help='JSON lines file the '
+              'results are appended to.')
+def run(samples, nstr, days, pairs, repeat, select, history):
+    """Run the benchmarks and append the results to the history."""
+
+    benchmarks = kernel_benchmarks(samples, nstr, days)
+    root = tempfile.mkdtemp(prefix="ms_stretch_bench_")
+    cwd = os.getcwd()
+    try:
+        names = generate_tree(root, pairs, days, nstr)
+        os.chdir(root)
+        benchmarks.update(loader_benchmarks(names))
+        results = {}
+        for name, func in benchmarks.items():
+            if select and select not in name:
+                continue
+            results[name] = time_call(func, repeat)
+            click.echo("%-30s min %9.4f s  median %9.4f s" %
+                       (name, results[name]["min"],
+                        results[name]["median"]))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root)
+
+    commit, dirty = git_commit()
+    record = {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+              "commit": commit, "dirty": dirty,
+              "machine": {"platform": platform.platform(),
+                          "processor": platform.processor(),
+                          "cpus": os.cpu_count(),
+                          "python": platform.python_version(),
+                          "numpy": np.__version__},
+              "params": {"samples": samples, "nstr": nstr, "days": days,
+                         "pairs": pairs},
+              "results": results}
+    with open(history, "a") as fp:
+        fp.write(json.dumps(record, sort_keys=True) + "\n")
+    click.echo("Results appended to %s" % history)
+
+
+@cli.command()
+@click.option('--history', default=HISTORY, help='JSON lines file of the '
+              'results.')
+@click.option('--last', default=2, help='Number of runs to compare.')
+def compare(history, last):
+    """Compare the median timings of the last runs with the same
+    parameters as the latest one."""
+
+    with open(history) as fp:
+        records = [json.loads(line) for line in fp if line.strip()]
+    if not records:
+        raise click.ClickException("No results in %s" % history)
+    params = records[-1]["params"]
+    records = [r for r in records if r["params"] == params][-last:]
+
+    click.echo("Parameters: %s" % json.dumps(params, sort_keys=True))
+    labels = ["%s%s" % ((r["commit"] or "unknown")[:8],
+                        "+" if r["dirty"] else "") for r in records]
+    click.echo("%-30s" % "benchmark" +
+               "".join("%12s" % label for label in labels) + "%10s" % "ratio")
+    names = sorted(set(name for r in records for name in r["results"]))
+    for name in names:
+        medians = [r["results"].get(name, {}).get("median")
+                   for r in records]
+        row = "%-30s" % name
+        row += "".join("%12s" % ("-" if m is None else "%.4f" % m)
+                       for m in medians)
+        if len(medians) > 1 and None not in medians[-2:]:
+            row += "%10.2f" % (medians[-1] / medians[-2])
+        click.echo(row)
+
+
+@cli.command()
+@click.option('--samples', default=6001, help='Samples of the synthetic '
+              'correlation functions.')
+@click.option('--nstr', default=1001, help='Number of stretching steps.')
+@click.option('--days', default=100, help='Number of days per noise level.')
+@click.option('--noise', default='0,0.2,0.5', help='Comma separated noise '
+              'levels, relative to the reference.')
+@click.option('--budget', default=None, type=float, help='Accepted '
+              'degradation of the bias and RMS error relative to the '
+              'exhaustive search. Half a stretching step by default.')
+@click.option('--mode', 'modes', multiple=True,
+              type=click.Choice(sorted(STRETCH_MODES)),
+              help='Modes to validate, all by default.')
+@click.option('--coherence', default=1., help='Coherence of the causal and '
+              'acausal sides of the reference, from 0 (independent) to 1 '
+              '(mirror images).')
+@click.option('--output', default=None, help='Also write the rows as JSON '
+              'to this file.')
+def validate(samples, nstr, days, noise, budget, modes, coherence, output):
+    """Check the accuracy of the stretching modes on synthetic days with a
+    known stretching. Fails if a mode is outside the budget."""
+
+    rows = validate_modes(n=samples, ndays=days,
+                          noise_levels=[float(n) for n in noise.split(",")],
+                          nstr=nstr, budget=budget, modes=modes or None,
+                          coherence=coherence)
+    click.echo("%-22s%8s%12s%12s%12s  %s" % ("mode", "noise", "bias", "rms",
+                                             "runtime", "accepted"))
+    for row in rows:
+        click.echo("%-22s%8.2f%12.2e%12.2e%11.4fs  %s" % (
+            row["mode"], row["noise"], row["bias"], row["rms"],
+            row["runtime"], "yes" if row["accepted"] else "NO"))
+    if output:
+        with open(output, "w") as fp:
+            json.dump(rows, fp, indent=2)
+    failed = sorted(set(row["mode"] for row in rows if not row["accepted"]))
+    if failed:
+        raise click.ClickException("Outside the accuracy budget: %s" %
+                                   ", ".join(failed))
+
+
+if __name__ == "__main__":
+    cli()
@@ -5,6 +5,9 @@ import re
 
 from msnoise.api import *
 
+from .default import default_config
+from .results import read_matrix
+
 def ask_stations(dir):
     """
     Asks which forcing stations to be used for plotting. Applies only if
@@ -120,6 +123,111 @@ def get_data(dir, stas):
     return data
 
 
+def norm_filterid(filterid):
+    """
+    Pad the filter number of a filterid with a 0 when needed, e.g. ``1`` to
+    ``01`` or ``1_10_30`` to ``01_10_30``. Already padded ids are returned
+    unchanged.
+
+    Input:
+        :type filterid: str
+        :param filterid: Filter, can contain stretching time window
+        information.
+
+    Output:
+        :type filterid: str
+        :param filterid: The filter with a two digit filter number.
+    """
+
+    number, sep, rest = str(filterid).partition("_")
+    return "%02i" % int(number) + sep + rest
+
+
+def find_str_table(filterid, mov_stack=10):
+    """
+    Find the columnar table of STR results of a filter and mov_stack, if
+    the results were exported to one (see the ``export`` setting).
+
+    Input:
+        :type filterid: str
+        :param filterid: Filter folder, can contain stretching time window
+        information.
+
+        :type mov_stack: int
+        :param mov_stack: Number of days that data is smoothed.
+
+    Output:
+        :type path: str
+        :param path: The Parquet or HDF5 table, None if there is none.
+    """
+
+    base = os.path.join("STR", "%s" % filterid, "%03i_DAYS" % mov_stack)
+    for extension in [".parquet", ".h5"]:
+        if os.path.isfile(base + extension):
+            return base + extension
+    return None
+
+
+def read_str_table(path, comps=None, pairs=None, start=None, end=None,
+                   columns=None):
+    """
+    Read STR results from a columnar table, loading only the requested
+    components, pairs and dates. The selection is pushed down to the file
+    reader, so row groups (Parquet) or rows (HDF5) that do not match are
+    not read at all.
+
+    Input:
+        :type path: str
+        :param path: The Parquet or HDF5 table, see :func:`find_str_table`.
+
+        :type comps: List of str
+        :param comps: Components to read, all if None.
+
+        :type pairs: List of str
+        :param pairs: Pairs to read (e.g. ``BE_UCC_BE_MEM``), all if None.
+
+        :type start: str or datetime
+        :param start: First date to read, no limit if None.
+
+        :type end: str or datetime
+        :param end: Last date to read, no limit if None.
+
+        :type columns: List of str
+        :param columns: Result columns to read (e.g. ``Delta``), all if None.
+
+    Output:
+        :type df: pandas DataFrame
+        :param df: The results, with Date, pair and component columns.
+    """
+
+    if columns is not None:
+        columns = ["Date", "pair", "component"] + list(columns)
+    if path.endswith(".parquet"):
+        filters = []
+        if comps:
+            filters.append(("component", "in", list(comps)))
+        if pairs:
+            filters.append(("pair", "in", list(pairs)))
+        if start is not None:
+            filters.append(("Date", ">=", pd.Timestamp(start)))
+        if end is not None:
+            filters.append(("Date", "<=", pd.Timestamp(end)))
+        return pd.read_parquet(path, columns=columns,
+                               filters=filters if filters else None)
+
+    where = []
+    if comps:
+        where.append("component=%r" % list(comps))
+    if pairs:
+        where.append("pair=%r" % list(pairs))
+    if start is not None:
+        where.append("Date>=%r" % str(pd.Timestamp(start)))
+    if end is not None:
+        where.append("Date<=%r" % str(pd.Timestamp(end)))
+    return pd.read_hdf(path, "str", where=where if where else None,
+                       columns=columns)
+
+
 def get_dvv(mov_stack=10, comps="ZZ", filterid="1", pairs_av=None):
     """
     Get the dvv data computed by the msnoise compute_stretch,
@@ -131,6 +239,9 @@ def get_dvv(mov_stack=10, comps="ZZ", filterid="1", pairs_av=None):
     the pairs to average over, in the plotting script the pairs
     are the pairs to be plotted.
 
+    If the results were exported to a columnar table (see
+    :func:`find_str_table`), only the requested rows are read from it.
+
     Input:
         :type mov_stack: int
         :param mov_stack: Number of days that data is smoothed.
@@ -151,7 +262,6 @@ def get_dvv(mov_stack=10, comps="ZZ", filterid="1", pairs_av=None):
         :param dvv_data: Daily mean and median dvv data.
     """
 
-    db = connect()
     # Treat components and pairs input
     if pairs_av:
         pairs_av = pairs_av.split(",")
@@ -159,36 +269,46 @@ def get_dvv(mov_stack=10, comps="ZZ", filterid="1", pairs_av=None):
         pairs_av = ["all"]
 
 
-    # Average over certain pairs or over all
-    # Usually only one pair or all are used
-    for pair in pairs_av:
-        first = True
-        for comp in comps:
-            filedir = os.path.join("STR","%s" % filterid,
-                               "%03i_DAYS" % mov_stack, comp)
-            #Either get all stations or only selected pairs
-            if "all" in pairs_av:
-                listfiles = os.listdir(path=filedir)
-            else:
-                file = pair + ".csv"
-                listfiles = [file]
-
-            for file in listfiles:
-                rf = os.path.join("STR","%s" % filterid,
-                                  "%03i_DAYS" % mov_stack, comp, file)
-
-                # Save the first df to be the reference
-                if first:
-                    df = pd.read_csv(rf, index_col=0,
-                                     parse_dates=True).iloc[:,0].to_frame()
-                    first = False
-                    continue
-
-                # Merge Dataframes for later averaging
-                df_temp = pd.read_csv(rf, index_col=0,
-                                     parse_dates=True).iloc[:,0].to_frame()
-                df = pd.merge(df, df_temp, left_index=True,
-                              right_index=True, how='outer')
+    filterid = norm_filterid(filterid)
+    table = find_str_table(filterid, mov_stack)
+    if table is not None:
+        if type(comps) is not list:
+            comps = comps.split(",")
+        pairs = None if "all" in pairs_av else pairs_av
+        df = read_str_table(table, comps=comps, pairs=pairs,
+                            columns=['Delta']).pivot_table(
+            index="Date", columns=["pair", "component"], values='Delta')
+    else:
+        # Average over certain pairs or over all
+        # Usually only one pair or all are used
+        for pair in pairs_av:
+            first = True
+            for comp in comps:
+                filedir = os.path.join("STR","%s" % filterid,
+                                   "%03i_DAYS" % mov_stack, comp)
+                #Either get all stations or only selected pairs
+                if "all" in pairs_av:
+                    listfiles = os.listdir(path=filedir)
+                else:
+                    file = pair + ".csv"
+                    listfiles = [file]
+
+                for file in listfiles:
+                    rf = os.path.join("STR","%s" % filterid,
+                                      "%03i_DAYS" % mov_stack, comp, file)
+
+                    # Save the first df to be the reference
+                    if first:
+                        df = pd.read_csv(rf, index_col=0,
+                                         parse_dates=True).iloc[:,0].to_frame(rf)
+                        first = False
+                        continue
+
+                    # Merge Dataframes for later averaging
+                    df_temp = pd.read_csv(rf, index_col=0,
+                                         parse_dates=True).iloc[:,0].to_frame(rf)
+                    df = pd.merge(df, df_temp, left_index=True,
+                                  right_index=True, how='outer')
 
     df.sort_values(by=['Date'])
     col1 = ((df.mean(axis=1)-1)*100).values
@@ -209,6 +329,12 @@ def get_dvv_mat(mov_stack=10, comps="ZZ", filterid="1", pairs_av=None):
     averaging is done by first stacking each stretching
     coefficient matrix and then extract the dvv values.
 
+    The matrices written by ``compute stretching`` (see the ``str_mat``
+    setting) are read without any text parsing, together with their
+    stretch axis. Older CSV matrices are still supported. Matrices with
+    another stretch axis than the first one are interpolated onto it. If a
+    pair has matrices in both binary formats, the newer one is read.
+
     Note: The pairs_av argument does not quite correspond to the
     pairs argument in the plotting scripts. Here it stands for
     the pairs to average over, in the plotting script the pairs
@@ -237,7 +363,6 @@ def get_dvv_mat(mov_stack=10, comps="ZZ", filterid="1", pairs_av=None):
         :param coeff_mat: Coefficient matrix averaged over given parameters.
     """
 
-    db = connect()
     #Treat components and pairs input
     if pairs_av:
         pairs_av = pairs_av.split(",")
@@ -251,51 +376,85 @@ def get_dvv_mat(mov_stack=10, comps="ZZ", filterid="1", pairs_av=None):
         else:
             comps = comps.split(",")
 
-    #Norm the filterid, add a 0 when needed
-    idx = filterid.find("_")
-    if len(filterid[:idx]) == 2:
-        pass
-    else:
-        filterid = "0" + filterid
+    filterid = norm_filterid(filterid)
 
-    for pair in pairs_av:
-        first = True
-        for comp in comps:
-            filedir = os.path.join("STR_Mat","%s" % filterid,
+    # Collect the (dates, coefficients, stretch axis) of every pair and
+    # component
+    mats = []
+    csv_deltas = None
+    for comp in comps:
+        filedir = os.path.join("STR_Mat","%s" % filterid,
                                "%03i_DAYS" % mov_stack, comp)
-            #Either get all stations or only selected pairs
-            if "all" in pairs_av:
-                listfiles = os.listdir(path=filedir)
-            else:
-                file = pair + ".csv"
-                listfiles = [file]
-
-            for file in listfiles:
-                rf = os.path.join("STR_Mat","%s" % filterid,
-                                  "%03i_DAYS" % mov_stack, comp, file)
-
-                #Save the first df to be the reference
-                if first:
-                    df_med = pd.read_csv(rf, index_col=0,
-                                        parse_dates=True)
-                    first = False
+        #Either get all stations or only selected pairs
+        if "all" in pairs_av:
+            names = set()
+            for file in os.listdir(path=filedir):
+                if file.endswith(".tmp") or file.endswith(".old"):
                     continue
+                names.add(os.path.splitext(file)[0]
+                          if file.endswith((".csv", ".h5")) else file)
+            names = sorted(names)
+        else:
+            names = pairs_av
+
+        for name in names:
+            rf = os.path.join(filedir, name)
+            found = [path for path in (rf, rf + ".h5")
+                     if os.path.isdir(path) or os.path.isfile(path)]
+            if found:
+                # Both formats exist if str_mat was changed, the last one
+                # written is the up to date one
+                dates, coeffs, deltas = read_matrix(
+                    max(found, key=os.path.getmtime))
+            else:
+                df_temp = pd.read_csv(rf + ".csv", index_col=0,
+                                      parse_dates=True)
+                dates = df_temp.index.values.astype("datetime64[D]")
+                coeffs = df_temp.values
+                if csv_deltas is None:
+                    # CSV matrices do not store their stretch axis
+                    db = connect()
+                    str_range = float(get_config(db, "stretching_max"))
+                    nstr = int(get_config(db, "stretching_nsteps"))
+                    csv_deltas = 1 + np.linspace(-str_range, str_range,
+                                                 nstr)
+                deltas = csv_deltas
+                if coeffs.shape[1] != len(deltas):
+                    raise ValueError(
+                        "%s has %i stretching steps, but the configuration "
+                        "has %i" % (rf + ".csv", coeffs.shape[1],
+                                    len(deltas)))
+            mats.append((dates, coeffs, np.asarray(deltas, dtype=np.float64)))
+
+    # The matrices are averaged on the stretch axis of the first one. The
+    # others (e.g. from hierarchical and exhaustive runs, or with another
+    # stretching_max) are interpolated onto it, leaving out what lies
+    # beyond their own range
+    deltas = mats[0][2]
+    alldates = np.unique(np.concatenate([dates for dates, _, _ in mats]))
+    sums = np.zeros((len(alldates), len(deltas)))
+    counts = np.zeros((len(alldates), len(deltas)))
+    for dates, coeffs, file_deltas in mats:
+        idx = np.searchsorted(alldates, dates)
+        coeffs = np.asarray(coeffs, dtype=np.float64)
+        if len(file_deltas) != len(deltas) or \
+                not np.allclose(file_deltas, deltas, rtol=0, atol=1e-9):
+            order = np.argsort(file_deltas)
+            coeffs = np.array([np.interp(deltas, file_deltas[order],
+                                         row[order], left=np.nan,
+                                         right=np.nan)
+                               for row in coeffs]).reshape(
+                (len(coeffs), len(deltas)))
+        valid = ~np.isnan(coeffs)
+        sums[idx] += np.where(valid, coeffs, 0.)
+        counts[idx] += valid
+    with np.errstate(invalid='ignore'):
+        coeff_mat = pd.DataFrame(sums / counts, columns=deltas,
+                                 index=pd.DatetimeIndex(alldates,
+                                                        name="Date"))
 
-                #Start averaging over all components
-                df_temp = pd.read_csv(rf, index_col=0,
-                                     parse_dates=True)
-                df_med = pd.concat([df_med, df_temp])
-
-    coeff_mat = df_med.groupby('Date').mean()
     #Compute dvv from averaged coefficient matrix
-    str_range = float(get_config(db, "stretching_max"))
-    nstr = int(get_config(db, "stretching_nsteps"))
-    alldeltas = []
-    allcoeffs = coeff_mat.values
-    deltas = 1 + np.linspace(-str_range, str_range, nstr)
-
-    for i in range(allcoeffs.shape[0]):
-        alldeltas.append(deltas[np.argmax(allcoeffs[i,:])])
+    alldeltas = deltas[np.argmax(coeff_mat.values, axis=1)]
 
     dvv_data = pd.DataFrame(alldeltas, index=coeff_mat.index)
     return dvv_data, coeff_mat
@@ -306,6 +465,9 @@ def get_corr(mov_stack=10, comps="ZZ", filterid="1", pairs_av=None):
     Return the correlation coefficients, averaged over the specified
     parameters.
 
+    If the results were exported to a columnar table (see
+    :func:`find_str_table`), only the requested rows are read from it.
+
     Input:
         :type mov_stack: int
         :param mov_stack: Number of days that data is smoothed.
@@ -326,7 +488,6 @@ def get_corr(mov_stack=10, comps="ZZ", filterid="1", pairs_av=None):
         :param corr_data: Daily mean and median dvv data.
     """
 
-    db = connect()
     # Treat components and pairs input
     if pairs_av:
         pairs_av = pairs_av.split(",")
@@ -340,43 +501,45 @@ def get_corr(mov_stack=10, comps="ZZ", filterid="1", pairs_av=None):
         else:
             comps = comps.split(",")
 
-    # Norm the filterid, add a 0 when needed
-    idx = filterid.find("_")
-    if len(filterid[:idx]) == 2:
-        pass
-    else:
-        filterid = "0" + filterid
-
-    # Average over certain pairs or over all
-    # Usually only one pair or all are used
-    for pair in pairs_av:
-        first = True
-        for comp in comps:
-            filedir = os.path.join("STR","%s" % filterid,
-                               "%03i_DAYS" % mov_stack, comp)
-            #Either get all stations or only selected pairs
-            if "all" in pairs_av:
-                listfiles = os.listdir(path=filedir)
-            else:
-                file = pair + ".csv"
-                listfiles = [file]
-
-            for file in listfiles:
-                rf = os.path.join("STR","%s" % filterid,
-                                  "%03i_DAYS" % mov_stack, comp, file)
-
-                # Save the first df to be the reference
-                if first:
-                    df = pd.read_csv(rf, index_col=0,
-                                     parse_dates=True).iloc[:,1].to_frame()
-                    first = False
-                    continue
+    filterid = norm_filterid(filterid)
 
-                # Merge Dataframes for later averaging
-                df_temp = pd.read_csv(rf, index_col=0,
-                                     parse_dates=True).iloc[:,1].to_frame()
-                df = pd.merge(df, df_temp, left_index=True,
-                              right_index=True, how='outer')
+    table = find_str_table(filterid, mov_stack)
+    if table is not None:
+        pairs = None if "all" in pairs_av else pairs_av
+        df = read_str_table(table, comps=comps, pairs=pairs,
+                            columns=['Coeff']).pivot_table(
+            index="Date", columns=["pair", "component"], values='Coeff')
+    else:
+        # Average over certain pairs or over all
+        # Usually only one pair or all are used
+        for pair in pairs_av:
+            first = True
+            for comp in comps:
+                filedir = os.path.join("STR","%s" % filterid,
+                                   "%03i_DAYS" % mov_stack, comp)
+                #Either get all stations or only selected pairs
+                if "all" in pairs_av:
+                    listfiles = os.listdir(path=filedir)
+                else:
+                    file = pair + ".csv"
+                    listfiles = [file]
+
+                for file in listfiles:
+                    rf = os.path.join("STR","%s" % filterid,
+                                      "%03i_DAYS" % mov_stack, comp, file)
+
+                    # Save the first df to be the reference
+                    if first:
+                        df = pd.read_csv(rf, index_col=0,
+                                         parse_dates=True).iloc[:,1].to_frame(rf)
+                        first = False
+                        continue
+
+                    # Merge Dataframes for later averaging
+                    df_temp = pd.read_csv(rf, index_col=0,
+                                         parse_dates=True).iloc[:,1].to_frame(rf)
+                    df = pd.merge(df, df_temp, left_index=True,
+                                  right_index=True, how='outer')
 
     df.sort_values(by=['Date'])
     col1 = df.mean(axis=1).values
@@ -396,11 +559,13 @@ def get_filter_info(filterid):
 
     Input:
         :type filterid: List of str
-        :param filterid: Filters to extract information from.
+        :param filterid: Filters to extract information from, e.g. ``1``,
+        ``01_10_30`` or ``01_10_30_causal``.
 
     Output:
         :type filterids: List of str
-        :param filterids: Filter ids without extra info and padded 0.
+        :param filterids: Filter ids padded with a 0, see
+        :func:`norm_filterid`.
 
         :type lows: List of floats
         :param lows: Lower frequency bound corresponding to filters.
@@ -422,18 +587,13 @@ def get_filter_info(filterid):
     lows = []
     highs = []
     for filter in filterid:
-        #Norm the filterid, add a 0 when needed
-        idx = filter.find("_")
-        if len(filter[:idx]) == 2:
-            pass
-        else:
-            filterids.append("0" + filter)
+        filterids.append(norm_filterid(filter))
         #Get stretching window information (try to get it of filter first)
         if len(filter) > 2:
-            idx = filter.find("_")
-            idx2 = filter.rfind("_")
-            minlag = float(filter[idx+1:idx2])
-            endlag = float(filter[idx2+1:])
+            # <filter>_<minlag>_<endlag>, optionally followed by the lag side
+            minlag, endlag = filter.split("_")[1:3]
+            minlag = float(minlag)
+            endlag = float(endlag)
         else:
             minlag = float(get_config(db, "dtt_minlag"))
             wwidth = float(get_config(db, "dtt_width"))
@@ -498,6 +658,36 @@ def get_config_p(session, isref=False, name=None, value=None,
     return config
 
 
+def get_stretch_config(session, name):
+    """Get the value of a config bit of the stretching computation.
+
+    The values are read from the StretchConfig table created by
+    ``msnoise p stretch plot install``. If the table or the config bit
+    does not exist, the default value from :mod:`ms_stretch.default` is
+    returned instead.
+
+    :type session: :class:`sqlalchemy.orm.session.Session`
+    :param session: A :class:`~sqlalchemy.orm.session.Session` object, as
+        obtained by :func:`connect`
+    :type name: str
+    :param name: The name of the config bit to get.
+
+    :rtype: str
+    :returns: the value for `name`
+    """
+    try:
+        config = get_config_p(session, name=name, value='value',
+                              plugin='Stretch')
+    except Exception:
+        # Table not installed yet
+        session.rollback()
+        config = ''
+    if config == '':
+        config = default_config[name][1]
+
+    return config
+
+
 def nicen_up_pairs(pairs, custom=False):
     """
     If no pairs are passed, all is returned to signal that
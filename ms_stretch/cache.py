@@ -0,0 +1,195 @@
+"""
+Cache of stretched reference matrices.
+
+The stretched (and normalized) version of a REF only depends on the REF
+data itself, on the lag time window that was masked in it and on the
+stretching parameters. It can thus be reused for every mov_stack of a run
+and, as long as the REF does not change, by every later run. The cache has
+two levels: an in-process LRU with a memory budget and an optional on-disk
+store of ``.npy`` files that are memory-mapped when read back. The store
+has a size limit too: the files are touched when read and the least
+recently used ones are removed when a new matrix pushes it over the limit,
+which also gets rid of the matrices of REFs that were replaced.
+"""
+
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+# Bump to invalidate the on-disk store if the cached matrices change layout
+CACHE_VERSION = 1
+
+
+def reference_key(ref, str_range, nstr, center=None, dtype=np.float64,
+                  local=None):
+    """
+    Hash identifying a stretched reference matrix.
+
+    Input:
+        :type ref: :class:`~numpy.ndarray`
+        :param ref: The reference trace, with the lag time window already
+        applied so that the mask is part of the key.
+
+        :type str_range: float
+        :param str_range: Amount of the desired stretching (one side)
+
+        :type nstr: int
+        :param nstr: Number of stretching steps
+
+        :type center: int
+        :param center: Index of the zero lag sample if it is not the
+        middle of the trace, e.g. 0 for folded traces.
+
+        :type dtype: :class:`~numpy.dtype`
+        :param dtype: Type of the stretched matrix.
+
+        :type local: tuple of int
+        :param local: ``(step, nsteps)`` of a local grid of ``nsteps``
+        steps around the ``step``-th step of the grid, for the fine grid
+        of the hierarchical search.
+
+    Output:
+        :type key: str
+        :param key: Hex digest of the reference and the parameters.
+    """
+
+    ref = np.ascontiguousarray(ref, dtype=np.float64)
+    h = hashlib.sha1()
+    h.update(ref.tobytes())
+    params = (CACHE_VERSION, ref.shape, float(str_range), int(nstr))
+    if center is not None:
+        params += (int(center), )
+    if np.dtype(dtype) != np.float64:
+        params += (np.dtype(dtype).name, )
+    if local is not None:
+        params += (("local", ) + tuple(int(i) for i in local), )
+    h.update(repr(params).encode())
+    return h.hexdigest()
+
+
+class StretchCache(object):
+    """
+    Two level cache of stretched reference matrices.
+
+    :type memory: float
+    :param memory: Memory budget of the in-process LRU (in MB). Matrices
+                   larger than the budget are not kept in memory.
+
+    :type folder: str
+    :param folder: Folder of the on-disk store. None disables it.
+
+    :type folder_size: float
+    :param folder_size: Size limit of the on-disk store (in MB), the least
+                        recently used files are removed beyond it. 0 for
+                        no limit.
+    """
+
+    def __init__(self, memory=512, folder=None, folder_size=0):
+        self.memory = int(float(memory) * 1024 ** 2)
+        self.folder = folder
+        self.folder_size = int(float(folder_size) * 1024 ** 2)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lru = OrderedDict()
+        self._size = 0
+
+    def get(self, key, builder):
+        """
+        Return the matrix stored under ``key``, building it with
+        ``builder()`` (and storing it) if it is in neither level.
+        """
+
+        if key in self._lru:
+            self._lru.move_to_end(key)
+            self.memory_hits += 1
+            return self._lru[key]
+
+        mat = self._load(key)
+        if mat is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            mat = builder()
+            self._save(key, mat)
+        self._remember(key, mat)
+        return mat
+
+    def stats(self):
+        """Hit and miss counters of the cache as a dict."""
+        return {"memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_used": self._size,
+                "entries": len(self._lru)}
+
+    def _remember(self, key, mat):
+        if mat.nbytes > self.memory:
+            return
+        self._lru[key] = mat
+        self._size += mat.nbytes
+        while self._size > self.memory:
+            _, old = self._lru.popitem(last=False)
+            self._size -= old.nbytes
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], key + ".npy")
+
+    def _load(self, key):
+        if not self.folder:
+            return None
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            mat = np.load(path, mmap_mode='r')
+            os.utime(path)
+            return mat
+        except (ValueError, OSError):
+            logging.debug("Corrupted cache file %s, rebuilding" % path)
+            return None
+
+    def _save(self, key, mat):
+        if not self.folder:
+            return
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so that concurrent readers never
+        # see a half written matrix
+        tmp = "%s.%i.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as fp:
+            np.save(fp, mat)
+        os.replace(tmp, path)
+        if self.folder_size:
+            self._prune(keep=path)
+
+    def _prune(self, keep):
+        # Remove the least recently used files (by modification time, which
+        # _load refreshes) until the store fits in its size limit
+        files = []
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                if not name.endswith(".npy"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.folder_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # Already removed by another worker
+                pass
+            total -= size
@@ -0,0 +1,267 @@
+"""
+Read-only snapshot of everything the stretching computation needs from the
+database: configuration, filters and the lag time window of every pair.
+It is built once at the start of a run and shared by all the workers, so
+that no database round trip is needed while processing the jobs.
+"""
+
+from collections import namedtuple
+
+from msnoise.api import *
+
+from .api import get_stretch_config
+
+
+RunContext = namedtuple('RunContext', [
+    'goal_sampling_rate', 'maxlag', 'extension', 'mov_stacks', 'components',
+    'filters', 'str_range', 'nstr', 'search', 'precision', 'coarse_nstr',
+    'fine_nstr', 'max_widen', 'memory_budget', 'cache_memory', 'cache_dir',
+    'cache_dir_size', 'dtt_lag', 'dtt_v', 'lag_windows', 'sides', 'io_threads',
+    'prefetch', 'mov_stack_source', 'exports', 'str_mat', 'str_mat_dtype',
+    'str_mat_compression', 'pairs'])
+RunContext.__doc__ = """Parameters of a stretching run.
+
+``filters`` holds ``(filterid, low, high)`` tuples, ``lag_windows`` the
+:class:`LagWindow` of every window to compute, ``sides`` the lag sides to
+compute (see :func:`parse_sides`) and ``pairs`` maps each pair
+(``NET.STA:NET.STA``) to its :class:`PairWindow` tuple, one per lag window.
+Treat as read-only.
+"""
+
+Filter = namedtuple('Filter', ['ref', 'low', 'high'])
+
+LagWindow = namedtuple('LagWindow', ['minlag', 'width'])
+LagWindow.__doc__ = """Lag time window as configured (in seconds).
+
+It names the STR folder of the results, ``STR/<filter>_<minlag>_<maxlag>``.
+With a dynamic ``dtt_lag``, the window of each pair starts at the
+interstation distance divided by ``dtt_v`` instead of ``minlag``.
+"""
+
+PairWindow = namedtuple('PairWindow', ['lag', 'distance', 'minlag',
+                                       'maxlag', 'samples'])
+PairWindow.__doc__ = """Lag time window of a pair.
+
+``lag`` is the :class:`LagWindow` it was derived from, ``minlag`` and
+``maxlag`` are in seconds. ``samples`` are the indices
+``(start, stop)`` of the causal side of the window in a trace, the acausal
+side being symmetric around its middle sample.
+"""
+
+
+def parse_lag_windows(value, minlag, width):
+    """
+    Parse the ``lag_windows`` setting.
+
+    Input:
+        :type value: str
+        :param value: Comma separated ``minlag:width`` windows (in seconds),
+        e.g. ``10:20,20:40``. Empty for the single window of the
+        ``dtt_minlag`` and ``dtt_width`` MSNoise settings.
+
+        :type minlag: float
+        :param minlag: The ``dtt_minlag`` setting.
+
+        :type width: float
+        :param width: The ``dtt_width`` setting.
+
+    Output:
+        :type windows: tuple of :class:`LagWindow`
+        :param windows: The windows, without duplicates.
+    """
+
+    if not value.strip():
+        return (LagWindow(minlag, width), )
+    windows = []
+    for item in value.split(","):
+        try:
+            start, length = item.split(":")
+            window = LagWindow(float(start), float(length))
+        except ValueError:
+            raise ValueError("Invalid lag window '%s' in lag_windows, "
+                             "expected minlag:width" % item.strip())
+        if window not in windows:
+            windows.append(window)
+    return tuple(windows)
+
+
+# Lag sides of the traces that can be stretched. "both" keeps the full
+# trace, "symmetric" averages (folds) the causal and acausal sides.
+SIDES = ("causal", "acausal", "both", "symmetric")
+SIDE_ALIASES = {"right": "causal", "left": "acausal"}
+
+
+def parse_sides(value):
+    """
+    Parse the ``dtt_sides`` setting.
+
+    Input:
+        :type value: str
+        :param value: One of :data:`SIDES` (``right`` and ``left`` are
+        accepted for ``causal`` and ``acausal``), several of them comma
+        separated, or ``all`` for all of them.
+
+    Output:
+        :type sides: tuple of str
+        :param sides: The sides, without duplicates.
+    """
+
+    if value.strip().lower() == "all":
+        return SIDES
+    sides = []
+    for item in value.split(","):
+        side = item.strip().lower()
+        side = SIDE_ALIASES.get(side, side)
+        if side not in SIDES:
+            raise ValueError("Invalid dtt_sides '%s', expected one of %s or "
+                             "all" % (item.strip(), ", ".join(SIDES)))
+        if side not in sides:
+            sides.append(side)
+    return tuple(sides)
+
+
+# Where the mov_stacks are read from: their own <mov>_DAYS stacks, or built
+# from the daily (001_DAYS) stacks
+MOV_STACK_SOURCES = ("stacks", "daily")
+
+
+def parse_mov_stack_source(value, stack_method="linear"):
+    """
+    Parse the ``mov_stack_source`` setting.
+
+    The mov_stacks built from the daily stacks are linear means, ``daily``
+    is thus only valid if MSNoise stacks linearly too.
+
+    Input:
+        :type value: str
+        :param value: One of :data:`MOV_STACK_SOURCES`.
+
+        :type stack_method: str
+        :param stack_method: The ``stack_method`` of MSNoise.
+
+    Output:
+        :type source: str
+        :param source: The source, lower case.
+    """
+
+    source = value.strip().lower()
+    if source not in MOV_STACK_SOURCES:
+        raise ValueError("Invalid mov_stack_source '%s', expected one of %s"
+                         % (value, ", ".join(MOV_STACK_SOURCES)))
+    if source == "daily" and stack_method.strip().lower() != "linear":
+        raise ValueError("mov_stack_source 'daily' builds linear stacks, "
+                         "but the stack_method is '%s'. Use 'stacks' to "
+                         "read the %s stacks of MSNoise" %
+                         (stack_method, stack_method))
+    return source
+
+
+def pair_windows(context, station1, station2):
+    """
+    Lag time windows of a pair of stations, one per configured lag window.
+
+    Input:
+        :type context: :class:`RunContext`
+        :param context: The parameters of the run.
+
+        :type station1: :class:`msnoise.msnoise_table_def.Station`
+        :param station1: First station of the pair.
+
+        :type station2: :class:`msnoise.msnoise_table_def.Station`
+        :param station2: Second station of the pair.
+
+    Output:
+        :type windows: tuple of :class:`PairWindow`
+        :param windows: The lag time windows of the pair, in the order of
+        ``context.lag_windows``.
+    """
+
+    distance = get_interstation_distance(station1, station2,
+                                         station1.coordinates)
+    mid = int(context.goal_sampling_rate * context.maxlag)
+    windows = []
+    for lag in context.lag_windows:
+        if context.dtt_lag == "static":
+            minlag = lag.minlag
+        else:
+            minlag = distance / context.dtt_v
+        maxlag = minlag + lag.width
+        samples = (mid + int(minlag * context.goal_sampling_rate),
+                   mid + int(maxlag * context.goal_sampling_rate))
+        windows.append(PairWindow(lag, distance, minlag, maxlag, samples))
+    return tuple(windows)
+
+
+def build_context(db):
+    """
+    Read the configuration, the filters and the station geometry of a run.
+
+    Input:
+        :type db: :class:`sqlalchemy.orm.session.Session`
+        :param db: A database session.
+
+    Output:
+        :type context: :class:`RunContext`
+        :param context: The parameters of the run, with the lag time
+        windows of every used station pair.
+    """
+
+    mov_stack = get_config(db, "mov_stack")
+    if mov_stack.count(',') == 0:
+        mov_stacks = [int(mov_stack), ]
+    else:
+        mov_stacks = [int(mi) for mi in mov_stack.split(',')]
+    params = get_params(db)
+    export_format = get_config(db, 'export_format')
+    if export_format == "BOTH":
+        extension = ".MSEED"
+    else:
+        extension = "."+export_format
+    cache_dir = get_stretch_config(db, "cache_dir")
+
+    context = RunContext(
+        goal_sampling_rate=float(get_config(db, "cc_sampling_rate")),
+        maxlag=float(get_config(db, "maxlag")),
+        extension=extension,
+        mov_stacks=tuple(mov_stacks),
+        components=tuple(params.all_components),
+        filters=tuple(Filter(int(f.ref), float(f.low), float(f.high))
+                      for f in get_filters(db, all=False)),
+        str_range=float(params.stretching_max),
+        nstr=int(params.stretching_nsteps),
+        search=get_stretch_config(db, "search"),
+        precision=get_stretch_config(db, "precision"),
+        coarse_nstr=int(get_stretch_config(db, "coarse_nsteps")),
+        fine_nstr=int(get_stretch_config(db, "fine_nsteps")),
+        max_widen=int(get_stretch_config(db, "max_widen")),
+        memory_budget=int(float(get_stretch_config(db, "memory_budget")) *
+                          1024 ** 2),
+        cache_memory=float(get_stretch_config(db, "cache_memory")),
+        cache_dir=cache_dir if cache_dir else None,
+        cache_dir_size=float(get_stretch_config(db, "cache_dir_size")),
+        dtt_lag=get_config(db, "dtt_lag"),
+        dtt_v=float(get_config(db, "dtt_v")),
+        lag_windows=parse_lag_windows(
+            get_stretch_config(db, "lag_windows"),
+            float(get_config(db, "dtt_minlag")),
+            float(get_config(db, "dtt_width"))),
+        sides=parse_sides(get_config(db, "dtt_sides")),
+        io_threads=int(get_stretch_config(db, "io_threads")),
+        prefetch=int(get_stretch_config(db, "prefetch")),
+        mov_stack_source=parse_mov_stack_source(
+            get_stretch_config(db, "mov_stack_source"),
+            get_config(db, "stack_method")),
+        exports=tuple(e.strip().lower() for e in
+                      get_stretch_config(db, "export").split(",")),
+        str_mat=get_stretch_config(db, "str_mat").lower(),
+        str_mat_dtype=get_stretch_config(db, "str_mat_dtype"),
+        str_mat_compression=get_stretch_config(
+            db, "str_mat_compression") or None,
+        pairs={})
+
+    for station1, station2 in get_station_pairs(db, used=True):
+        pair = "%s.%s:%s.%s" % (station1.net, station1.sta,
+                                station2.net, station2.sta)
+        context.pairs[pair] = pair_windows(context, station1, station2)
+
+    return context
@@ -4,3 +4,65 @@ default = OrderedDict()
 
 default['prec'] = ["Enter the default station or 'all'.", 'Precipitation',
                    'precipitation', 'all', 'mm', 'bars']
+
+
+# Configuration of the compute stretching command
+default_config = OrderedDict()
+
+default_config['memory_budget'] = ["Working memory (in MB) of building one "
+                                   "stretched reference, larger ones are "
+                                   "correlated in tiles. The cache_memory "
+                                   "comes on top. 0 for no limit", '0']
+default_config['cache_memory'] = ["Memory budget of the in-process cache of "
+                                  "stretched references (in MB)", '512']
+default_config['cache_dir'] = ["Folder of the on-disk cache of stretched "
+                               "references. Empty (default) disables it.",
+                               '']
+default_config['cache_dir_size'] = ["Size limit of the on-disk cache (in MB), "
+                                    "the least recently used references are "
+                                    "removed beyond it. 0 for no limit",
+                                    '2048']
+default_config['search'] = ["Stretching search: 'exhaustive' evaluates every "
+                            "one of the stretching_nsteps, 'hierarchical' "
+                            "refines a coarse grid around its peak",
+                            'exhaustive']
+default_config['precision'] = ["Precision of the stretched references and "
+                               "correlations: float64 or float32 (half the "
+                               "memory, sums still in float64)", 'float64']
+default_config['coarse_nsteps'] = ["Number of steps of the coarse grid of "
+                                   "the hierarchical search", '101']
+default_config['fine_nsteps'] = ["Number of steps of the local fine grid of "
+                                 "the hierarchical search", '21']
+default_config['max_widen'] = ["How often the hierarchical search may double "
+                               "the stretching range if the peak is on its "
+                               "edge", '2']
+default_config['lease_timeout'] = ["Time (in s) after which the STR jobs "
+                                   "claimed by a crashed worker are given "
+                                   "back", '3600']
+default_config['lag_windows'] = ["Lag time windows computed in one pass, "
+                                 "comma separated minlag:width (in s), e.g. "
+                                 "'10:20,20:40'. Empty for dtt_minlag and "
+                                 "dtt_width", '']
+default_config['io_threads'] = ["Number of threads reading the day stacks "
+                                "of a pair", '4']
+default_config['prefetch'] = ["Number of stacks (REF or days of one "
+                              "mov_stack) read ahead in the background while "
+                              "the stretching is computed. 0 to read them "
+                              "when needed", '2']
+default_config['mov_stack_source'] = ["Read every mov_stack from its own "
+                                      "STACKS/<mov>_DAYS (stacks), or only "
+                                      "read the 001_DAYS stacks and build "
+                                      "all the mov_stacks from them (daily, "
+                                      "linear stack_method only)",
+                                      'stacks']
+default_config['export'] = ["Formats of the STR results, comma separated: "
+                            "csv (one file per pair), parquet and/or hdf5 "
+                            "(one table per filter and mov_stack)", 'csv']
+default_config['str_mat'] = ["Also save the full coefficient matrices in "
+                             "STR_Mat: none, npy (memory-mappable) or hdf5",
+                             'none']
+default_config['str_mat_dtype'] = ["Storage type of the coefficient matrices:"
+                                   " float16, float32 or float64", 'float32']
+default_config['str_mat_compression'] = ["Compression of the hdf5 coefficient"
+                                         " matrices: gzip, lzf or empty for "
+                                         "none", '']
@@ -1,5 +1,5 @@
 # Table definitions for default forcing stations
-from sqlalchemy import Column, String, Integer
+from sqlalchemy import BigInteger, Column, String, Integer
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
@@ -49,3 +49,71 @@ class DefaultStations(Base):
         self.default_station = default_station
         self.unit = unit
         self.plot_type = plot_type
+
+
+class StretchConfig(Base):
+    """
+    Config Object of the stretching computation
+
+    :type ref: int
+    :param ref: The reference ID of the config bit.
+
+    :type short_name: str
+    :param short_name: The name of the config bit.
+
+    :type value: str
+    :param value: The value of the config bit.
+
+    :type description: str
+    :param description: A short explanation of the config bit.
+    """
+    __tablename__ = "stretch-config"
+    ref = Column(Integer, primary_key=True)
+    short_name = Column(String(255))
+    value = Column(String(255))
+    description = Column(String(255))
+
+    def __init__(self, short_name, value, description):
+        """"""
+        self.short_name = short_name
+        self.value = value
+        self.description = description
+
+
+class RefFingerprint(Base):
+    """
+    Fingerprint of a REF stack the STR results were computed with
+
+    :type ref: int
+    :param ref: The reference ID of the fingerprint.
+
+    :type filterid: int
+    :param filterid: The filter of the REF.
+
+    :type components: str
+    :param components: The components of the REF.
+
+    :type pair: str
+    :param pair: The pair of the REF (``NET.STA:NET.STA``).
+
+    :type mtime: int
+    :param mtime: The modification time of the REF file (ns).
+
+    :type digest: str
+    :param digest: The SHA1 hex digest of the content of the REF file.
+    """
+    __tablename__ = "stretch-refs"
+    ref = Column(Integer, primary_key=True)
+    filterid = Column(Integer)
+    components = Column(String(8))
+    pair = Column(String(255))
+    mtime = Column(BigInteger)
+    digest = Column(String(40))
+
+    def __init__(self, filterid, components, pair, mtime, digest):
+        """"""
+        self.filterid = filterid
+        self.components = components
+        self.pair = pair
+        self.mtime = mtime
+        self.digest = digest
@@ -16,7 +16,7 @@ from matplotlib.dates import DateFormatter
 from matplotlib.dates import MonthLocator
 
 from msnoise.api import *
-
+from ..api import find_str_table, read_str_table
 
 
 def main(mov_stack=None, components='ZZ', filterid=1, pairs=[],
@@ -53,20 +53,31 @@ def main(mov_stack=None, components='ZZ', filterid=1, pairs=[],
     first_plot = True
     for i, mov_stack in enumerate(mov_stacks):
         alldf = []
-        for comp in components:
-            filedir = os.path.join("STR","%02i" % filterid,
-                               "%03i_DAYS" % mov_stack, comp)
+        table = find_str_table("%02i" % filterid, mov_stack)
+        if table is not None:
+            # One column per pair and component
+            df = read_str_table(table, comps=components,
+                                columns=['Delta'])
+            if len(df):
+                alldf.append(df.pivot_table(index="Date",
+                                            columns=["pair", "component"],
+                                            values='Delta'))
+        else:
+            for comp in components:
+                filedir = os.path.join("STR","%02i" % filterid,
+                                   "%03i_DAYS" % mov_stack, comp)
 
-            listfiles = os.listdir(path=filedir)
-            for file in listfiles:
-                rf = os.path.join("STR","%02i" % filterid,
-                                  "%03i_DAYS" % mov_stack, comp, file)
+                listfiles = os.listdir(path=filedir)
+                for file in listfiles:
+                    rf = os.path.join("STR","%02i" % filterid,
+                                      "%03i_DAYS" % mov_stack, comp, file)
 
-                # Append all series and give them the pair names
-                s = pd.read_csv(rf, index_col=0, parse_dates=True).iloc[:,0]
-                s = pd.Series(s, name=file[:-4])
+                    # Append all series and give them the pair names
+                    s = pd.read_csv(rf, index_col=0,
+                                    parse_dates=True).iloc[:,0]
+                    s = pd.Series(s, name=file[:-4])
 
-                alldf.append(s)
+                    alldf.append(s)
 
         if len(alldf) == 0:
             print("No Data for %s m%i f%i" % (components, mov_stack, filterid))
@@ -81,7 +92,7 @@ def main(mov_stack=None, components='ZZ', filterid=1, pairs=[],
             else:
                 plt.subplot(gs[i], sharex=ax)
 
-            alldf_mean = (alldf.groupby(axis=1, level=0).mean()-1)*100
+            alldf_mean = (alldf.T.groupby(level=0).mean().T-1)*100
             for pair in pairs:
                 print(pair)
                 pair1 = alldf_mean[pair].copy()
@@ -15,7 +15,8 @@ from matplotlib.dates import DateFormatter
 from matplotlib.dates import MonthLocator
 
 from msnoise.api import *
-from ..api import get_dvv, get_filter_info, nicen_up_pairs
+from ..api import get_corr, get_dvv, get_filter_info, \
+    nicen_up_pairs
 
 
 def main(mov_stack=10, components='ZZ', filterid='1', pairs=None, custom=False,
@@ -43,53 +44,11 @@ def main(mov_stack=10, components='ZZ', filterid='1', pairs=None, custom=False,
     dflist = []
     dflist_corr = []
     for pair in pairs:
-        first = True
-        for comp in components:
-
-            filedir = os.path.join("STR","%s" % filterid,
-                                   "%03i_DAYS" % mov_stack, comp)
-
-            #Either get all stations or only selected pairs
-            if "all" in pairs:
-                listfiles = os.listdir(path=filedir)
-            else:
-               file = pair + ".csv"
-               listfiles = [file]
-
-            for file in listfiles:
-                rf = os.path.join("STR","%s" % filterid,
-                                  "%03i_DAYS" % mov_stack, comp, file)
-
-                #Save the first df to be the reference
-                if first:
-                    df_med = pd.read_csv(rf, index_col=0,
-                                        parse_dates=True).iloc[:,0].to_frame()
-                    df_corr = pd.read_csv(rf, index_col=0,
-                                         parse_dates=True).iloc[:,1].to_frame()
-                    first = False
-                    continue
-
-                # Merge all the dataframes for later averaging
-                df_temp = pd.read_csv(rf, index_col=0,
-                                     parse_dates=True).iloc[:,0].to_frame()
-                df_temp2 = pd.read_csv(rf, index_col=0,
-                                      parse_dates=True).iloc[:,1].to_frame()
-                df_med = pd.merge(df_med, df_temp, left_index=True,
-                                 right_index=True, how='outer')
-                df_corr = pd.merge(df_corr, df_temp2, left_index=True,
-                                  right_index=True, how='outer')
-
-        df_med.sort_values(by=['Date'])
-        col1 = ((df_med.mean(axis=1)-1)*100).values
-        col2 = ((df_med.median(axis=1)-1)*100).values
-        data = {"mean": col1, "median": col2}
-        dvv_data = pd.DataFrame(data, index=df_med.index)
-
-        df_corr.sort_values(by=['Date'])
-        col1 = df_corr.mean(axis=1).values
-        col2 = df_corr.median(axis=1).values
-        data = {"mean": col1, "median": col2}
-        corr_data = pd.DataFrame(data, index=df_corr.index)
+        # Read from the columnar tables of the results if they were exported
+        # to some, from the CSV files otherwise
+        pairs_av = None if pair == "all" else pair
+        dvv_data = get_dvv(mov_stack, components, filterid, pairs_av)
+        corr_data = get_corr(mov_stack, components, filterid, pairs_av)
 
         dflist.append(dvv_data)
         dflist_corr.append(corr_data)
@@ -2,12 +2,15 @@
 
 Create a table in the database called Default Stations
 that is used for the forcing commands. Database table
-can be dropped with the uninstall command."""
+can be dropped with the uninstall command. The configuration
+table of the stretching computation and the registry of the REF
+fingerprints are created as well."""
 
 from msnoise.api import *
 
-from .default_table_def import DefaultStations
-from .default import default
+from .default_table_def import DefaultStations, RefFingerprint, \
+    StretchConfig
+from .default import default, default_config
 
 def main():
     engine = get_engine()
@@ -30,4 +33,15 @@ def main():
                                     default_station=default_station,
                                     unit=unit, plot_type=plot_type))
 
+    StretchConfig.__table__.create(bind=engine, checkfirst=True)
+    RefFingerprint.__table__.create(bind=engine, checkfirst=True)
+    # Only add the config bits that are missing, keep the user's values
+    existing = [config.short_name for config in session.query(StretchConfig)]
+    for short_name in default_config.keys():
+        if short_name in existing:
+            continue
+        description, value = default_config[short_name]
+        session.add(StretchConfig(short_name=short_name, value=value,
+                                  description=description))
+
     session.commit()
@@ -0,0 +1,231 @@
+"""
+Leasing of the STR (MWCS) jobs.
+
+Jobs are claimed pair by pair with a single conditional UPDATE that only
+succeeds if none of the jobs of the pair was claimed by somebody else in
+the meantime. A claimed job is flagged "I" and its ``lastmod`` is the
+lease timestamp, taken from the clock of the database. Leases older than
+the timeout are considered to belong to a crashed worker and their jobs
+are put back to "T"odo. All database accesses retry with an exponential
+backoff on lock contention instead of failing or spinning.
+
+As with ``get_dtt_next_job`` of MSNoise, the jobs of the REF "day" are
+never claimed, counted as pending nor reset: they are not days to stretch.
+"""
+
+import random
+
+from msnoise.api import *
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+
+
+def backoff(attempt, base=0.05, cap=5.):
+    """
+    Sleep a random time that grows exponentially with the attempt number.
+
+    Input:
+        :type attempt: int
+        :param attempt: Number of previous failed attempts.
+
+        :type base: float
+        :param base: Maximum sleep of the first retry (s).
+
+        :type cap: float
+        :param cap: Upper bound of the sleep (s).
+    """
+
+    time.sleep(random.uniform(0, min(cap, base * 2 ** attempt)))
+
+
+def retry(db, action, retries=10):
+    """
+    Run ``action()``, retrying with :func:`backoff` if the database is
+    locked. The session is rolled back before each retry.
+
+    Input:
+        :type db: :class:`sqlalchemy.orm.session.Session`
+        :param db: The database session used by ``action``.
+
+        :type action: callable
+        :param action: Function doing the database work.
+
+        :type retries: int
+        :param retries: Number of retries before the error is raised.
+
+    Output:
+        The return value of ``action()``.
+    """
+
+    for attempt in range(retries + 1):
+        try:
+            return action()
+        except OperationalError:
+            db.rollback()
+            if attempt == retries:
+                raise
+            logging.debug("Database locked, retrying (%i)" % (attempt + 1))
+            backoff(attempt)
+
+
+def reclaim_expired(db, jobtype='MWCS', timeout=3600):
+    """
+    Put the jobs of expired leases back to "T"odo.
+
+    Input:
+        :type db: :class:`sqlalchemy.orm.session.Session`
+        :param db: A database session.
+
+        :type jobtype: str
+        :param jobtype: Type of the jobs.
+
+        :type timeout: float
+        :param timeout: Duration of a lease (s).
+
+    Output:
+        :type count: int
+        :param count: Number of jobs that were reclaimed.
+    """
+
+    def action():
+        now = db.query(func.now()).scalar()
+        if isinstance(now, str):
+            now = datetime.datetime.strptime(now, "%Y-%m-%d %H:%M:%S")
+        expired = now - datetime.timedelta(seconds=timeout)
+        count = db.query(Job).filter(Job.jobtype == jobtype,
+                                     Job.flag == 'I',
+                                     Job.lastmod < expired).\
+            update({Job.flag: 'T'}, synchronize_session=False)
+        db.commit()
+        return count
+
+    count = retry(db, action)
+    if count:
+        logging.info("Reclaimed %i %s jobs from expired leases" %
+                     (count, jobtype))
+    return count
+
+
+def claim_jobs(db, jobtype='MWCS', npairs=1):
+    """
+    Lease all the pending jobs of up to ``npairs`` pairs.
+
+    Pairs whose jobs are (partially) claimed by another worker while
+    trying are skipped and left to the other worker.
+
+    Input:
+        :type db: :class:`sqlalchemy.orm.session.Session`
+        :param db: A database session.
+
+        :type jobtype: str
+        :param jobtype: Type of the jobs.
+
+        :type npairs: int
+        :param npairs: Maximum number of pairs to claim.
+
+    Output:
+        :type leases: list of tuples
+        :param leases: One ``(pair, refs, days)`` tuple per claimed pair.
+    """
+
+    pairs = retry(db, lambda: [
+        pair for pair, in db.query(Job.pair).
+        filter(Job.jobtype == jobtype, Job.flag == 'T', Job.day != 'REF').
+        distinct().limit(npairs)])
+
+    leases = []
+    for pair in pairs:
+        def action():
+            jobs = db.query(Job.ref, Job.day).\
+                filter(Job.jobtype == jobtype, Job.flag == 'T',
+                       Job.day != 'REF', Job.pair == pair).all()
+            if not jobs:
+                return None
+            refs, days = zip(*jobs)
+            claimed = db.query(Job).\
+                filter(Job.ref.in_(refs), Job.flag == 'T').\
+                update({Job.flag: 'I', Job.lastmod: func.now()},
+                       synchronize_session=False)
+            if claimed != len(refs):
+                # Somebody else was faster for some of the jobs
+                db.rollback()
+                return None
+            db.commit()
+            return pair, list(refs), list(days)
+
+        lease = retry(db, action)
+        if lease is not None:
+            leases.append(lease)
+    return leases
+
+
+def has_pending_jobs(db, jobtype='MWCS'):
+    """
+    Check whether there are jobs to do left.
+
+    Input:
+        :type db: :class:`sqlalchemy.orm.session.Session`
+        :param db: A database session.
+
+        :type jobtype: str
+        :param jobtype: Type of the jobs.
+
+    Output:
+        :type pending: bool
+        :param pending: True if at least one job is flagged "T".
+    """
+
+    return retry(db, lambda: db.query(Job.ref).filter(
+        Job.jobtype == jobtype, Job.flag == 'T',
+        Job.day != 'REF').first() is not None)
+
+
+def reset_jobs(db, pair, jobtype='MWCS'):
+    """
+    Flag all the done jobs of a pair "T"odo again, e.g. to recompute its
+    full history. Jobs that are leased are left alone.
+
+    Input:
+        :type db: :class:`sqlalchemy.orm.session.Session`
+        :param db: A database session.
+
+        :type pair: str
+        :param pair: The pair (``NET.STA:NET.STA``).
+
+        :type jobtype: str
+        :param jobtype: Type of the jobs.
+
+    Output:
+        :type count: int
+        :param count: Number of jobs that were reset.
+    """
+
+    def action():
+        count = db.query(Job).filter(Job.jobtype == jobtype,
+                                     Job.pair == pair, Job.flag == 'D',
+                                     Job.day != 'REF').\
+            update({Job.flag: 'T'}, synchronize_session=False)
+        db.commit()
+        return count
+
+    return retry(db, action)
+
+
+def complete_jobs(db, refs):
+    """
+    Flag the given jobs as done, in one bulk update.
+
+    Input:
+        :type db: :class:`sqlalchemy.orm.session.Session`
+        :param db: A database session.
+
+        :type refs: list of int
+        :param refs: The ``ref`` of the jobs to update.
+    """
+
+    def action():
+        db.bulk_update_mappings(Job, [{'ref': ref, 'flag': "D"}
+                                      for ref in refs])
+        db.commit()
+
+    retry(db, action)
@@ -0,0 +1,130 @@
+"""
+Layout of the stretching computation on the CPU cores of a node.
+
+``compute stretching -t N`` starts N worker processes, and each of them
+may start a BLAS (and OpenMP) thread pool with as many threads as there
+are cores, which oversubscribes the node. The layout splits a budget of
+cores between the worker processes and the BLAS threads of each worker,
+and optionally pins every worker to its own cores.
+
+The BLAS thread pools are limited at run time with ``threadpoolctl`` if
+it is installed. Otherwise only the usual environment variables are set,
+which the BLAS libraries only read when they are loaded.
+"""
+
+from collections import namedtuple
+import os
+
+# Environment variables read by the BLAS and OpenMP libraries when loaded
+BLAS_VARIABLES = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                  "MKL_NUM_THREADS", "BLIS_NUM_THREADS",
+                  "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+CpuLayout = namedtuple('CpuLayout', ['cores', 'workers', 'blas_threads',
+                                     'cpu_sets'])
+CpuLayout.__doc__ = """Split of the cores of a node between the workers.
+
+``cores`` is the budget of cores, ``blas_threads`` the size of the BLAS
+thread pool of every worker and ``cpu_sets`` the cores every worker is
+pinned to (one tuple per worker), None if they are not pinned.
+"""
+
+
+def available_cores():
+    """
+    The cores the current process may run on.
+
+    Output:
+        :type cores: list of int
+        :param cores: The sorted core ids.
+    """
+
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def cpu_layout(workers, cores=None, blas_threads=None, pin=False):
+    """
+    Split a budget of cores between worker processes and their BLAS
+    threads.
+
+    Input:
+        :type workers: int
+        :param workers: Number of processes computing the stretching.
+
+        :type cores: int
+        :param cores: Budget of cores, all the available cores by default.
+        It can not exceed them.
+
+        :type blas_threads: int
+        :param blas_threads: BLAS threads of every worker, by default the
+        budget divided by the number of workers (at least 1).
+
+        :type pin: bool
+        :param pin: Pin every worker to ``blas_threads`` cores of its own,
+        taken in order from the available cores.
+
+    Output:
+        :type layout: :class:`CpuLayout`
+        :param layout: The layout.
+    """
+
+    available = available_cores()
+    if cores is None or cores > len(available):
+        cores = len(available)
+    cores = max(1, cores)
+    if blas_threads is None:
+        blas_threads = max(1, cores // workers)
+    cpu_sets = None
+    if pin:
+        # More threads than cores in the budget share the cores round robin
+        used = available[:cores]
+        cpu_sets = tuple(
+            tuple(sorted(set(used[(i * blas_threads + j) % cores]
+                             for j in range(blas_threads))))
+            for i in range(workers))
+    return CpuLayout(cores, workers, blas_threads, cpu_sets)
+
+
+def apply_layout(layout, index=0):
+    """
+    Limit the BLAS threads of the current process and pin it to its cores.
+
+    Input:
+        :type layout: :class:`CpuLayout`
+        :param layout: The layout of the run.
+
+        :type index: int
+        :param index: Index of the worker in the layout.
+
+    Output:
+        :type limited: bool
+        :param limited: False if the BLAS threads could only be limited
+        through environment variables, see the module documentation.
+    """
+
+    for name in BLAS_VARIABLES:
+        os.environ[name] = str(layout.blas_threads)
+    if layout.cpu_sets is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, layout.cpu_sets[index % layout.workers])
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return False
+    threadpool_limits(limits=layout.blas_threads)
+    return True
+
+
+def describe(layout):
+    """One line description of a layout, for the logs."""
+
+    text = "%i cores: %i worker(s) x %i BLAS thread(s)" % (
+        layout.cores, layout.workers, layout.blas_threads)
+    if layout.workers * layout.blas_threads > layout.cores:
+        text += " (oversubscribed)"
+    if layout.cpu_sets is None:
+        return text + ", not pinned"
+    return text + ", pinned to " + " | ".join(
+        ",".join(str(cpu) for cpu in cpus) for cpus in layout.cpu_sets)
@@ -0,0 +1,241 @@
+"""
+Dry run of ``compute stretching``: estimate the work represented by the
+pending STR (MWCS) jobs without computing or claiming anything.
+
+The pending jobs, and all the jobs of the pairs whose REF changed since
+the last run, are grouped by pair and the STACKS tree is listed once
+per pair, filter, component and mov_stack to find the day stacks that
+would actually be read. From there the number of correlations, the bytes
+to read and the memory of a worker follow from the run parameters.
+"""
+
+from msnoise.api import *
+
+from .context import build_context
+from .stacks import moving_stacks, window_days
+from .references import check_references
+from .stretch import stretch_memory
+
+
+def pending_days(db, jobtype='MWCS', changed=()):
+    """
+    Days of the pending jobs of every pair.
+
+    Input:
+        :type db: :class:`sqlalchemy.orm.session.Session`
+        :param db: A database session.
+
+        :type jobtype: str
+        :param jobtype: Type of the jobs.
+
+        :type changed: list of str
+        :param changed: Pairs whose REF changed, their done jobs are
+        pending too (see :mod:`~ms_stretch.references`).
+
+    Output:
+        :type days: dict
+        :param days: The days (``YYYY-MM-DD``) of each pair.
+    """
+
+    days = {}
+    for pair, day in db.query(Job.pair, Job.day).\
+            filter(Job.jobtype == jobtype, Job.flag == 'T',
+                   Job.day != 'REF'):
+        days.setdefault(pair, []).append(str(day))
+    if changed:
+        for pair, day in db.query(Job.pair, Job.day).\
+                filter(Job.jobtype == jobtype, Job.flag == 'D',
+                       Job.day != 'REF', Job.pair.in_(list(changed))):
+            days.setdefault(pair, []).append(str(day))
+    return days
+
+
+def stack_files(folder, days, extension):
+    """Files of the given days in a folder of stacks, sorted."""
+    try:
+        files = os.listdir(folder)
+    except OSError:
+        return []
+    days = set(days)
+    return sorted(f for f in files if f.endswith(extension) and
+                  f[:-len(extension)] in days)
+
+
+def estimate(context, jobs, threads=1):
+    """
+    Estimate the cost of computing the given jobs.
+
+    Input:
+        :type context: :class:`~ms_stretch.context.RunContext`
+        :param context: The parameters of the run.
+
+        :type jobs: dict
+        :param jobs: The days to compute of each pair, see
+        :func:`pending_days`.
+
+        :type threads: int
+        :param threads: Number of workers the run would use.
+
+    Output:
+        :type plan: dict
+        :param plan: The number of ``pairs``, ``jobs``, ``traces`` to read
+        (days found in STACKS, and REFs) and ``missing`` days, the
+        ``correlations`` to evaluate, the ``bytes`` to read, the peak
+        ``memory`` of a worker (bytes, including its stretched REF cache)
+        and the ``recommended_workers``.
+    """
+
+    sr = context.goal_sampling_rate
+    mid = int(sr * context.maxlag)
+    lengths = {"both": 2 * mid + 1}
+    for side in context.sides:
+        lengths.setdefault(side, mid + 1)
+    itemsize = np.dtype(context.precision).itemsize
+    nwindows = len(context.lag_windows)
+    if context.search == "hierarchical":
+        nstr = context.coarse_nstr
+        per_day = context.coarse_nstr + context.fine_nstr
+    else:
+        nstr = context.nstr
+        per_day = context.nstr
+
+    # Stretched REFs of one component, for all the sides and windows
+    matrices = 0
+    building = 0
+    for side in context.sides:
+        size = nstr * lengths[side] * itemsize
+        peak = stretch_memory(lengths[side], nstr, context.precision)
+        if context.memory_budget and context.search != "hierarchical" and \
+                peak > context.memory_budget:
+            # Correlated in tiles, coordinates included
+            matrices += nwindows * context.memory_budget
+        else:
+            matrices += nwindows * size
+            # Coordinates and normalized copy while a matrix is built
+            building = max(building, peak - size)
+
+    plan = {"pairs": len(jobs), "jobs": sum(len(d) for d in jobs.values()),
+            "traces": 0, "missing": 0, "correlations": 0, "bytes": 0}
+    max_days = 0
+    # Samples x days of the daily stacks and mov_stacks built from them
+    max_built = 0
+    for pair, days in jobs.items():
+        ref_name = pair.replace('.', '_').replace(':', '_')
+        days = sorted(set(days))
+        for filterid, _, _ in context.filters:
+            for components in context.components:
+                ref = os.path.join("STACKS", "%02i" % filterid, "REF",
+                                   components, ref_name + context.extension)
+                if not os.path.isfile(ref):
+                    continue
+                plan["traces"] += 1
+                plan["bytes"] += os.path.getsize(ref)
+                if context.mov_stack_source == "daily":
+                    folder = os.path.join("STACKS", "%02i" % filterid,
+                                          "001_DAYS", components, ref_name)
+                    window = window_days(days, max(context.mov_stacks))
+                    daily = stack_files(folder, window, context.extension)
+                    plan["traces"] += len(daily)
+                    plan["bytes"] += sum(os.path.getsize(
+                        os.path.join(folder, f)) for f in daily)
+                    # Only the found days matter, not the samples
+                    built = moving_stacks(
+                        days, [f[:-len(context.extension)] for f in daily],
+                        np.empty((len(daily), 0)), context.mov_stacks)
+                    founds = [built[mov_stack][0]
+                              for mov_stack in context.mov_stacks]
+                    if daily:
+                        span = (np.datetime64(days[-1]) -
+                                np.datetime64(daily[0][:10])).astype(int) + 1
+                        max_built = max(max_built, len(daily) + span +
+                                        sum(len(f) for f in founds))
+                else:
+                    founds = []
+                    for mov_stack in context.mov_stacks:
+                        folder = os.path.join(
+                            "STACKS", "%02i" % filterid,
+                            "%03i_DAYS" % mov_stack, components, ref_name)
+                        found = stack_files(folder, days, context.extension)
+                        plan["traces"] += len(found)
+                        plan["bytes"] += sum(os.path.getsize(
+                            os.path.join(folder, f)) for f in found)
+                        founds.append(found)
+                for found in founds:
+                    plan["missing"] += len(days) - len(found)
+                    plan["correlations"] += len(found) * per_day * \
+                        nwindows * len(context.sides)
+                    max_days = max(max_days, len(found))
+
+    # Loaded days, their masked and normalized copies and the coefficients
+    days_memory = max_days * lengths["both"] * 8 * 3 + \
+        max_days * nstr * 8 * 2 + max_built * lengths["both"] * 8
+    # Stacks read ahead
+    prefetch_memory = context.prefetch * max_days * lengths["both"] * 8
+    plan["memory"] = int(matrices + building + days_memory +
+                         prefetch_memory + context.cache_memory * 1024 ** 2)
+    plan["memory_details"] = {"stretched_refs": int(matrices),
+                              "building": int(building),
+                              "days": int(days_memory),
+                              "prefetch": int(prefetch_memory),
+                              "cache": int(context.cache_memory * 1024 ** 2)}
+
+    workers = min(os.cpu_count() or 1, max(1, len(jobs)))
+    try:
+        available = os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        available = None
+    if available and plan["memory"]:
+        workers = max(1, min(workers, int(available // plan["memory"])))
+    plan["available_memory"] = available
+    plan["recommended_workers"] = workers
+    plan["threads"] = threads
+    return plan
+
+
+def format_bytes(value):
+    """Human readable size of ``value`` bytes."""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(value) < 1024:
+            return "%.1f %s" % (value, unit)
+        value /= 1024.
+    return "%.1f TB" % value
+
+
+def main(threads=1):
+    """
+    Print the estimated cost of the pending STR (MWCS) jobs.
+
+    Input:
+        :type threads: int
+        :param threads: Number of workers the run would use.
+
+    Output:
+        :type plan: dict
+        :param plan: The estimate, see :func:`estimate`.
+    """
+
+    db = connect()
+    context = build_context(db)
+    changed = check_references(db, context)[0]
+    plan = estimate(context, pending_days(db, changed=changed), threads)
+    db.close()
+
+    print("Pending STR (MWCS) jobs: %i days of %i pairs" %
+          (plan["jobs"], plan["pairs"]))
+    if changed:
+        print("REF changed for:         %i pairs, full history included "
+              "above" % len(changed))
+    print("Traces to read:          %i (%s), %i days without a stack" %
+          (plan["traces"], format_bytes(plan["bytes"]), plan["missing"]))
+    print("Correlations:            %.3g (%s search, %i windows, %s)" %
+          (plan["correlations"], context.search, len(context.lag_windows),
+           ", ".join(context.sides)))
+    print("Peak memory per worker:  %s" % format_bytes(plan["memory"]))
+    for name, value in plan["memory_details"].items():
+        print("    %-20s %s" % (name, format_bytes(value)))
+    if plan["available_memory"]:
+        print("Physical memory:         %s" %
+              format_bytes(plan["available_memory"]))
+    print("Recommended workers:     %i (-t %i requested)" %
+          (plan["recommended_workers"], threads))
+    return plan
@@ -1,8 +1,7 @@
 import click
-import time
 
 from flask_admin.contrib.sqla import ModelView
-from .default_table_def import DefaultStations
+from .default_table_def import DefaultStations, StretchConfig
 
 
 @click.group()
@@ -141,7 +140,8 @@ def install():
 
     Create a table in the database called Default Stations
     that is used for the forcing commands. Database table
-    can be dropped with the uninstall command."""
+    can be dropped with the uninstall command. Also creates
+    the configuration table of the stretching computation."""
     from .install import main
     main()
 
@@ -151,7 +151,8 @@ def uninstall():
     """Drop default stations table in database.
 
     Deletes Default Stations entry in the current database. Normally
-    the entry should also disappear in the admin viewer."""
+    the entry should also disappear in the admin viewer. The stretching
+    configuration table is dropped as well."""
     from .uninstall import main
     main()
 
@@ -162,28 +163,37 @@ def compute():
 
 
 @click.command()
-@click.option('-t', '--threads', default=1, help='Number of threads to use \
-(only affects modules that are designed to do parallel processing)')
-@click.option('-d', '--delay', default=1,  help='In the case of multi-threading'
-                    ', defines the number of seconds to wait before lauching '
-                    'the next thread. Defaults to [1] second ')
+@click.option('-t', '--threads', default=1, help='Number of worker processes \
+computing the stretching. The jobs are claimed and the results written by \
+the main process only.')
+@click.option('-d', '--delay', default=1,  help='Deprecated, kept for '
+                    'compatibility. The workers are now started as a pool '
+                    'and this value is ignored.')
+@click.option('--profile', default=None, type=str, help='Time the stages of '
+              'the computation and count what they do, and write the '
+              'report to this JSON file.')
+@click.option('--plan', is_flag=True, help='Only estimate the work of the '
+              'pending jobs (correlations, bytes to read, memory per worker) '
+              'without computing anything.')
+@click.option('--cores', default=None, type=int, help='Budget of CPU cores '
+              'shared by the workers and their BLAS threads. All the '
+              'available cores by default.')
+@click.option('--blas-threads', default=None, type=int, help='BLAS threads '
+              'of every worker. By default the cores divided by the number '
+              'of workers.')
+@click.option('--pin', is_flag=True, help='Pin every worker to its own '
+              'cores.')
 @click.pass_context
-def stretching(ctx, threads, delay):
+def stretching(ctx, threads, delay, profile, plan, cores, blas_threads, pin):
     """Computes the stretching based on the new stacked data"""
-    from .stretch import main
     loglevel = ctx.obj['MSNOISE_verbosity']
-    if threads == 1:
-        main()
-    else:
-        from multiprocessing import Process
-        processes = []
-        for i in range(threads):
-            p = Process(target=main)
-            p.start()
-            processes.append(p)
-            time.sleep(delay)
-        for p in processes:
-            p.join()
+    if plan:
+        from .planner import main
+        main(threads=threads)
+        return
+    from .stretch import main
+    main(threads=threads, profile=profile, cores=cores,
+         blas_threads=blas_threads, pin=pin)
 
 
 stretch.add_command(plot)
@@ -222,3 +232,24 @@ class DefaultStationsView(ModelView):
                                                   name="Default Stations",
                                                   category="Stretch",
                                                   **kwargs)
+
+
+class StretchConfigView(ModelView):
+    # Disable model creation
+    view_title = "MSNoise Stretching Configuration"
+    name = "Configuration"
+
+    can_create = False
+    can_delete = False
+    page_size = 50
+    # Override displayed fields
+    column_list = ('short_name', 'value', 'description')
+    column_editable_list = ('value',)
+
+    def __init__(self, session, **kwargs):
+        # You can pass name and other parameters if you want to
+        super(StretchConfigView, self).__init__(StretchConfig, session,
+                                                endpoint="stretchconfig",
+                                                name="Stretching",
+                                                category="Stretch",
+                                                **kwargs)
@@ -0,0 +1,132 @@
+"""
+Profiling of the stretching computation.
+
+A :class:`Profiler` accumulates the time spent in named stages and named
+counters (traces read, correlations evaluated, ...). Every worker process
+has its own profiler; their reports are merged by the main process and
+written as a JSON file. A disabled profiler does no work at all, its
+stages are a shared no-op context manager.
+"""
+
+import contextlib
+import json
+import os
+import time
+
+
+class _Stage(object):
+    """Context manager adding its duration to a stage of a profiler."""
+
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stage = self.profiler.stages.setdefault(self.name, [0., 0])
+        stage[0] += time.perf_counter() - self.start
+        stage[1] += 1
+        return False
+
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class Profiler(object):
+    """
+    Stage timers and counters of a process.
+
+    :type enabled: bool
+    :param enabled: If False, :meth:`stage` and :meth:`count` do nothing.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = {}
+        self.counters = {}
+
+    def stage(self, name):
+        """
+        Context manager timing a stage, e.g.
+        ``with profiler.stage("read"): ...``. Stages can be nested, each
+        one is timed on its own.
+        """
+
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def count(self, name, value=1):
+        """Add ``value`` to the counter ``name``."""
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        """
+        Stages and counters as a dict that can be dumped to JSON: ``stages``
+        maps each stage to its total ``seconds`` and number of ``calls``.
+        """
+
+        return {"stages": {name: {"seconds": seconds, "calls": calls}
+                           for name, (seconds, calls) in
+                           self.stages.items()},
+                "counters": dict(self.counters)}
+
+
+def merge_reports(reports):
+    """
+    Sum several :meth:`Profiler.report` dicts.
+
+    Input:
+        :type reports: list of dict
+        :param reports: The reports, e.g. one per worker.
+
+    Output:
+        :type report: dict
+        :param report: The summed stages and counters.
+    """
+
+    merged = {"stages": {}, "counters": {}}
+    for report in reports:
+        for name, stage in report["stages"].items():
+            total = merged["stages"].setdefault(name,
+                                                {"seconds": 0., "calls": 0})
+            total["seconds"] += stage["seconds"]
+            total["calls"] += stage["calls"]
+        for name, value in report["counters"].items():
+            merged["counters"][name] = merged["counters"].get(name, 0) + value
+    return merged
+
+
+def write_report(path, main, workers, elapsed):
+    """
+    Write the profiling report of a run to a JSON file.
+
+    Input:
+        :type path: str
+        :param path: The JSON file, replaced atomically.
+
+        :type main: dict
+        :param main: The report of the main process (database, writing).
+
+        :type workers: dict
+        :param workers: The latest report of each worker, keyed by pid.
+
+        :type elapsed: float
+        :param elapsed: Wall clock time of the run so far (s).
+    """
+
+    report = {"elapsed": elapsed,
+              "main": main,
+              "workers": {str(pid): worker for pid, worker in
+                          workers.items()},
+              "total": merge_reports([main] + list(workers.values()))}
+    tmp = "%s.%i.tmp" % (path, os.getpid())
+    with open(tmp, "w") as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
+    os.replace(tmp, path)
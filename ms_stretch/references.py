@@ -0,0 +1,145 @@
+"""
+Registry of the REF stacks the STR results were computed with.
+
+Every REF (filter x component x pair) is fingerprinted by the
+modification time and the SHA1 of the content of its file. At the start
+of a run, a pair with a REF whose content changed since the last run has
+all its done STR (MWCS) jobs flagged "T"odo again, so that its full
+history is recomputed with the new REF. The other pairs only compute
+their newly flagged days. The content is only hashed when the
+modification time changed, so that copying or touching a REF without
+changing it does not trigger a recomputation.
+"""
+
+import hashlib
+
+from msnoise.api import *
+from sqlalchemy import inspect
+
+from .default_table_def import RefFingerprint
+from .jobs import reset_jobs, retry
+
+
+def file_hash(path, chunk=1024 ** 2):
+    """
+    SHA1 of the content of a file.
+
+    Input:
+        :type path: str
+        :param path: Path to the file.
+
+        :type chunk: int
+        :param chunk: Number of bytes read at once.
+
+    Output:
+        :type digest: str
+        :param digest: Hex digest of the content.
+    """
+
+    h = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def check_references(db, context):
+    """
+    Compare the REF files of the used pairs with the registry.
+
+    A REF that is not in the registry yet is recorded without invalidating
+    the results of its pair, as there is no way to tell which REF they were
+    computed with.
+
+    Input:
+        :type db: :class:`sqlalchemy.orm.session.Session`
+        :param db: A database session.
+
+        :type context: :class:`~ms_stretch.context.RunContext`
+        :param context: The parameters of the run.
+
+    Output:
+        :type changed: set of str
+        :param changed: The pairs with at least one REF whose content
+        changed.
+
+        :type updates: list of tuples
+        :param updates: ``(fingerprint, mtime, digest)`` of every REF to
+        record, ``fingerprint`` is the
+        :class:`~ms_stretch.default_table_def.RefFingerprint` to update,
+        or the ``(filterid, components, pair)`` of a new one.
+    """
+
+    known = {}
+    if inspect(db.get_bind()).has_table(RefFingerprint.__tablename__):
+        known = {(f.filterid, f.components, f.pair): f
+                 for f in retry(db, lambda: db.query(RefFingerprint).all())}
+
+    changed = set()
+    updates = []
+    for pair in context.pairs:
+        ref_name = pair.replace('.', '_').replace(':', '_')
+        for filterid, _, _ in context.filters:
+            for components in context.components:
+                path = os.path.join("STACKS", "%02i" % filterid, "REF",
+                                    components, ref_name + context.extension)
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+                fingerprint = known.get((filterid, components, pair))
+                if fingerprint is not None and fingerprint.mtime == mtime:
+                    continue
+                digest = file_hash(path)
+                if fingerprint is None:
+                    fingerprint = (filterid, components, pair)
+                elif fingerprint.digest != digest:
+                    changed.add(pair)
+                updates.append((fingerprint, mtime, digest))
+    return changed, updates
+
+
+def update_references(db, context, jobtype='MWCS'):
+    """
+    Flag "T"odo again all the done jobs of the pairs whose REF changed
+    since the last run, then record the new fingerprints.
+
+    Input:
+        :type db: :class:`sqlalchemy.orm.session.Session`
+        :param db: A database session.
+
+        :type context: :class:`~ms_stretch.context.RunContext`
+        :param context: The parameters of the run.
+
+        :type jobtype: str
+        :param jobtype: Type of the jobs.
+
+    Output:
+        :type changed: list of str
+        :param changed: The pairs whose full history will be recomputed.
+    """
+
+    RefFingerprint.__table__.create(bind=db.get_bind(), checkfirst=True)
+    changed, updates = check_references(db, context)
+
+    # The jobs are reset before the fingerprints are recorded, so that an
+    # interrupted run resets them again the next time
+    changed = sorted(changed)
+    for pair in changed:
+        count = reset_jobs(db, pair, jobtype)
+        logging.info("The REF of %s changed, recomputing its %i done STR "
+                     "days" % (pair, count))
+
+    def action():
+        for fingerprint, mtime, digest in updates:
+            if isinstance(fingerprint, tuple):
+                db.add(RefFingerprint(*fingerprint, mtime=mtime,
+                                      digest=digest))
+            else:
+                fingerprint.mtime = mtime
+                fingerprint.digest = digest
+        db.commit()
+
+    if updates:
+        retry(db, action)
+    return changed
@@ -0,0 +1,355 @@
+"""
+Storage of the stretching results (STR folder).
+
+Results are merged into the existing series of each pair instead of
+replacing them, so that a run only needs to compute the days flagged by its
+jobs while the files keep the full history.
+
+Besides the CSV file per pair, the results can be exported to columnar
+tables, one per filter/window and mov_stack (``STR/<filter>/<mov>_DAYS``
+with a ``.parquet`` or ``.h5`` extension), where pair and component are
+columns. Readers can then load only the rows they need (see
+:func:`~ms_stretch.api.read_str_table`).
+
+The full days x nstr coefficient matrices can also be kept in the STR_Mat
+folder, in a binary format (see :func:`write_matrix`).
+"""
+
+import shutil
+import tempfile
+
+from msnoise.api import *
+
+
+def merge_csv(path, df):
+    """
+    Insert or update the rows of a DataFrame in a CSV file.
+
+    Rows of ``df`` replace the rows of the file with the same date, the
+    others are kept. The result is sorted by date and written to a
+    temporary file first, then moved over the old one, so that readers never
+    see a partially written file.
+
+    Input:
+        :type path: str
+        :param path: The CSV file, it is created if needed.
+
+        :type df: pandas DataFrame
+        :param df: The new rows, indexed by date.
+
+    Output:
+        :type merged: pandas DataFrame
+        :param merged: The full series that was written.
+    """
+
+    if os.path.isfile(path):
+        old = pd.read_csv(path, index_col=0, parse_dates=True)
+        df = pd.concat([old[~old.index.isin(df.index)], df])
+    df = df[~df.index.duplicated(keep='last')].sort_index()
+
+    tmp = "%s.%i.tmp" % (path, os.getpid())
+    df.to_csv(tmp, index_label="Date")
+    os.replace(tmp, path)
+    return df
+
+
+# Extension of the columnar tables for each export format
+TABLE_EXTENSIONS = {"parquet": ".parquet", "hdf5": ".h5"}
+# Columns identifying a row of a columnar table
+TABLE_KEYS = ["Date", "pair", "component"]
+
+
+def str_folder(filterid, lag, side="both"):
+    """
+    Name of the STR folder of a filter, including the lag time window and
+    the lag side if it is not both sides.
+
+    Input:
+        :type filterid: int
+        :param filterid: The filter id.
+
+        :type lag: :class:`~ms_stretch.context.LagWindow`
+        :param lag: The lag time window.
+
+        :type side: str
+        :param side: The lag side, see :data:`~ms_stretch.context.SIDES`.
+
+    Output:
+        :type folder: str
+        :param folder: The folder, e.g. ``STR/01_10_30`` or
+        ``STR/01_10_30_causal``.
+    """
+
+    # Include lag time window in filter folder
+    new_filter = "%02i_" % filterid
+    new_filter += str(int(lag.minlag)) + "_"
+    new_filter += str(int(lag.minlag) + int(lag.width))
+    if side != "both":
+        new_filter += "_" + side
+    return os.path.join('STR', new_filter)
+
+
+def write_table(path, df):
+    """
+    Write a columnar table of STR results, replacing the file atomically.
+
+    Rows are sorted by date, pair and component. Parquet files get one row
+    group per month so that date filters can skip whole row groups, HDF5
+    files are written in table format with the key columns indexed.
+
+    Input:
+        :type path: str
+        :param path: The file, its extension selects the format.
+
+        :type df: pandas DataFrame
+        :param df: The rows to write, with the :data:`TABLE_KEYS` columns.
+    """
+
+    df = df.sort_values(TABLE_KEYS).reset_index(drop=True)
+    tmp = "%s.%i.tmp" % (path, os.getpid())
+    if path.endswith(TABLE_EXTENSIONS["parquet"]):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        writer = pq.ParquetWriter(tmp, schema)
+        for _, chunk in df.groupby(df["Date"].dt.to_period("M")):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema,
+                                                    preserve_index=False))
+        writer.close()
+    else:
+        df.to_hdf(tmp, key="str", mode="w", format="table",
+                  data_columns=TABLE_KEYS, complevel=5)
+    os.replace(tmp, path)
+
+
+def read_table(path):
+    """
+    Read a whole columnar table of STR results.
+
+    Input:
+        :type path: str
+        :param path: The file, its extension selects the format.
+
+    Output:
+        :type df: pandas DataFrame
+        :param df: The rows of the table.
+    """
+
+    if path.endswith(TABLE_EXTENSIONS["parquet"]):
+        return pd.read_parquet(path)
+    return pd.read_hdf(path, "str")
+
+
+class ColumnarStore(object):
+    """
+    Buffer of STR results exported to columnar tables.
+
+    Rewriting a table is costly, so results are buffered and merged into
+    the tables by :meth:`flush`, once ``max_rows`` rows are waiting or at
+    the end of the run.
+
+    :type formats: list of str
+    :param formats: The export formats, ``parquet`` and/or ``hdf5``.
+
+    :type max_rows: int
+    :param max_rows: Number of buffered rows that triggers a flush.
+    """
+
+    def __init__(self, formats, max_rows=100000):
+        self.formats = list(formats)
+        self.max_rows = max_rows
+        self._tables = {}
+        self.pending = 0
+        try:
+            if "parquet" in self.formats:
+                import pyarrow
+            if "hdf5" in self.formats:
+                import tables
+        except ImportError as e:
+            raise ImportError("Exporting STR results as %s needs an optional "
+                              "dependency: %s" % (", ".join(self.formats), e))
+
+    def add(self, table, ref_name, components, df):
+        """Buffer the results of one pair and component for a table."""
+        df = df.rename_axis("Date").reset_index()
+        df["pair"] = ref_name
+        df["component"] = components
+        self._tables.setdefault(table, []).append(df)
+        self.pending += len(df)
+
+    def full(self):
+        """True if enough rows are buffered to flush them."""
+        return self.pending >= self.max_rows
+
+    def flush(self):
+        """Merge all buffered rows into their tables."""
+        for table, dfs in self._tables.items():
+            new = pd.concat(dfs, ignore_index=True)
+            for export in self.formats:
+                path = table + TABLE_EXTENSIONS[export]
+                df = new
+                if os.path.isfile(path):
+                    old = read_table(path)
+                    old_keys = pd.MultiIndex.from_frame(old[TABLE_KEYS])
+                    new_keys = pd.MultiIndex.from_frame(new[TABLE_KEYS])
+                    df = pd.concat([old[~old_keys.isin(new_keys)], new],
+                                   ignore_index=True)
+                df = df.drop_duplicates(TABLE_KEYS, keep="last")
+                write_table(path, df)
+        self._tables = {}
+        self.pending = 0
+
+
+def write_matrix(path, dates, coeffs, deltas, dtype="float32",
+                 compression=None):
+    """
+    Merge a days x nstr coefficient matrix into its binary file.
+
+    Two formats are supported, selected by the extension of ``path``:
+
+    * no extension: a folder holding ``coeffs.npy``, ``dates.npy`` and
+      ``deltas.npy``, that can be memory-mapped when read back.
+    * ``.h5``: an HDF5 file (needs h5py) with the same three datasets, the
+      coefficients being stored in chunks of days, optionally compressed.
+
+    Days already in the file are replaced, the others are kept. If the
+    stretch axis of the file differs, it is replaced entirely.
+
+    Input:
+        :type path: str
+        :param path: The folder or the ``.h5`` file.
+
+        :type dates: :class:`~numpy.ndarray`
+        :param dates: 1d ndarray of the days (datetime64[D]).
+
+        :type coeffs: :class:`~numpy.ndarray`
+        :param coeffs: 2d ndarray (days x nstr) of correlation coefficients.
+
+        :type deltas: :class:`~numpy.ndarray`
+        :param deltas: 1d ndarray, stretch amount of every column.
+
+        :type dtype: str
+        :param dtype: Storage type of the coefficients, e.g. ``float16``.
+
+        :type compression: str
+        :param compression: HDF5 compression filter (``gzip``, ``lzf``),
+        None for no compression.
+    """
+
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    coeffs = np.asarray(coeffs, dtype=dtype)
+    if os.path.exists(path):
+        old_dates, old_coeffs, old_deltas = read_matrix(path)
+        if len(old_deltas) == len(deltas) and np.allclose(old_deltas, deltas):
+            keep = ~np.isin(old_dates, dates)
+            dates = np.concatenate([old_dates[keep], dates])
+            coeffs = np.concatenate([np.asarray(old_coeffs[keep], dtype=dtype),
+                                     coeffs])
+    order = np.argsort(dates, kind="stable")
+    dates, coeffs = dates[order], coeffs[order]
+
+    tmp = "%s.%i.tmp" % (path, os.getpid())
+    if path.endswith(".h5"):
+        import h5py
+        with h5py.File(tmp, "w") as fp:
+            chunks = (max(1, min(len(dates), 64)), coeffs.shape[1]) \
+                if len(dates) else None
+            fp.create_dataset("coeffs", data=coeffs, chunks=chunks,
+                              compression=compression)
+            fp.create_dataset("dates", data=dates.astype("int64"))
+            fp.create_dataset("deltas", data=np.asarray(deltas))
+        os.replace(tmp, path)
+        return
+
+    # A unique folder, so that the leftovers of an interrupted write do not
+    # get in the way
+    tmp = tempfile.mkdtemp(prefix=os.path.basename(path) + ".",
+                           suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        np.save(os.path.join(tmp, "coeffs.npy"), coeffs)
+        np.save(os.path.join(tmp, "dates.npy"), dates)
+        np.save(os.path.join(tmp, "deltas.npy"), np.asarray(deltas))
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    # A folder cannot replace another one atomically, keep the old one
+    # aside until the new one is in place
+    if os.path.exists(path):
+        old = tmp + ".old"
+        os.rename(path, old)
+        os.rename(tmp, path)
+        shutil.rmtree(old)
+    else:
+        os.rename(tmp, path)
+
+
+def read_matrix(path):
+    """
+    Read a coefficient matrix written by :func:`write_matrix`.
+
+    Input:
+        :type path: str
+        :param path: The folder or the ``.h5`` file.
+
+    Output:
+        :type dates: :class:`~numpy.ndarray`
+        :param dates: 1d ndarray of the days (datetime64[D]).
+
+        :type coeffs: :class:`~numpy.ndarray`
+        :param coeffs: 2d ndarray (days x nstr), memory-mapped if possible.
+
+        :type deltas: :class:`~numpy.ndarray`
+        :param deltas: 1d ndarray, stretch amount of every column.
+    """
+
+    if path.endswith(".h5"):
+        import h5py
+        with h5py.File(path, "r") as fp:
+            return (fp["dates"][:].astype("datetime64[D]"),
+                    fp["coeffs"][:], fp["deltas"][:])
+    return (np.load(os.path.join(path, "dates.npy")),
+            np.load(os.path.join(path, "coeffs.npy"), mmap_mode="r"),
+            np.load(os.path.join(path, "deltas.npy")))
+
+
+def write_results(context, output, store=None):
+    """
+    Merge the results of :func:`~ms_stretch.stretch.compute_pair` into the
+    STR folder.
+
+    Input:
+        :type context: :class:`~ms_stretch.context.RunContext`
+        :param context: Read-only parameters of the run.
+
+        :type output: dict
+        :param output: The output of :func:`~ms_stretch.stretch.compute_pair`.
+
+        :type store: :class:`ColumnarStore`
+        :param store: Columnar tables the results are also exported to.
+    """
+
+    ref_name = output["pair"].replace('.', '_').replace(':', '_')
+    for filterid, lag, side, mov_stack, components, df, mat in \
+            output["results"]:
+        table = os.path.join(str_folder(filterid, lag, side),
+                             "%03i_DAYS" % mov_stack)
+        if mat is not None and len(df):
+            coeffs, deltas = mat
+            folder = os.path.join("STR_Mat", os.path.basename(
+                str_folder(filterid, lag, side)), "%03i_DAYS" % mov_stack,
+                components)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            path = os.path.join(folder, ref_name)
+            if context.str_mat == "hdf5":
+                path += ".h5"
+            write_matrix(path, df.index.values, coeffs, deltas,
+                         dtype=context.str_mat_dtype,
+                         compression=context.str_mat_compression)
+        if "csv" in context.exports:
+            folder = os.path.join(table, components)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            merge_csv(os.path.join(folder, "%s.csv" % ref_name), df)
+        if store is not None:
+            store.add(table, ref_name, components, df)
@@ -0,0 +1,316 @@
+"""
+Reading of the stacked cross-correlations (REF and day stacks) for the
+stretching computation.
+
+:class:`PairStacks` reads the stacks of a pair ahead of their use in
+background threads, so that the disk (or network filesystem) latency is
+hidden behind the computation.
+"""
+
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from msnoise.api import *
+
+
+def read_trace(path):
+    """
+    Read the data of a stacked cross-correlation.
+
+    Input:
+        :type path: str
+        :param path: Path to the file.
+
+    Output:
+        :type data: :class:`~numpy.ndarray`
+        :param data: 1d ndarray of the samples.
+    """
+
+    return read(path)[0].data
+
+
+def load_days(folder, days, extension, mask=None, threads=4):
+    """
+    Read the stacks of several days of a pair into one 2d array.
+
+    The folder is listed once instead of checking every file, the files are
+    read by a pool of threads and the lag time window mask is applied to
+    all the days at once. Days without a file are skipped.
+
+    Input:
+        :type folder: str
+        :param folder: Folder of the day stacks of one pair, i.e.
+        ``STACKS/<filter>/<mov>_DAYS/<comp>/<pair>``.
+
+        :type days: list of str
+        :param days: Days to read (``YYYY-MM-DD``).
+
+        :type extension: str
+        :param extension: Extension of the files, e.g. ``.MSEED``.
+
+        :type mask: :class:`~numpy.ndarray`
+        :param mask: 1d ndarray multiplied with every trace. None keeps the
+        full traces, e.g. to apply several lag time windows afterwards.
+
+        :type threads: int
+        :param threads: Number of threads reading files.
+
+    Output:
+        :type found: list of str
+        :param found: The days that were found, in the order of ``days``.
+
+        :type data: :class:`~numpy.ndarray`
+        :param data: 2d float64 ndarray (days x samples) of the masked
+        traces. Without mask and without any day, it has no samples.
+    """
+
+    try:
+        available = set(os.listdir(folder))
+    except OSError:
+        available = set()
+    found = [str(day) for day in days if str(day) + extension in available]
+    paths = [os.path.join(folder, day + extension) for day in found]
+
+    if len(paths) > 1 and threads > 1:
+        executor = ThreadPoolExecutor(max_workers=threads)
+        traces = executor.map(read_trace, paths)
+    else:
+        executor = None
+        traces = map(read_trace, paths)
+
+    data = None
+    if mask is not None or not paths:
+        data = np.empty((len(paths), 0 if mask is None else len(mask)))
+    for i, trace in enumerate(traces):
+        if data is None:
+            data = np.empty((len(paths), len(trace)))
+        data[i] = trace
+    if executor is not None:
+        executor.shutdown()
+    if mask is not None:
+        data *= mask
+    return found, data
+
+
+def window_days(days, mov_stack):
+    """
+    Days of the daily stacks needed to stack ``mov_stack`` days at every
+    given day, i.e. from ``mov_stack - 1`` days before each day to the day.
+
+    Input:
+        :type days: list of str
+        :param days: The days of the moving stacks (``YYYY-MM-DD``).
+
+        :type mov_stack: int
+        :param mov_stack: The longest moving stack.
+
+    Output:
+        :type window: list of str
+        :param window: The sorted days of the daily stacks.
+    """
+
+    dates = np.array([str(day) for day in days], dtype="datetime64[D]")
+    window = np.unique((dates[:, np.newaxis] -
+                        np.arange(mov_stack)[np.newaxis, :]).ravel())
+    return [str(day) for day in window]
+
+
+def moving_stacks(days, found, data, mov_stacks):
+    """
+    Moving stacks of daily stacks, built for all mov_stacks at once from
+    cumulative sums along the days.
+
+    As for the ``<mov>_DAYS`` stacks of MSNoise, the stack of ``mov_stack``
+    days at a day is the mean of the daily stacks available from
+    ``mov_stack - 1`` days before to that day. Days without any daily
+    stack in their window are left out.
+
+    Input:
+        :type days: list of str
+        :param days: The days of the moving stacks (``YYYY-MM-DD``).
+
+        :type found: list of str
+        :param found: The days of the daily stacks, see :func:`load_days`.
+
+        :type data: :class:`~numpy.ndarray`
+        :param data: 2d ndarray (days x samples) of the daily stacks.
+
+        :type mov_stacks: list of int
+        :param mov_stacks: The numbers of days to stack.
+
+    Output:
+        :type stacks: dict
+        :param stacks: ``(found, data)`` of every mov_stack, as returned by
+        :func:`load_days`.
+    """
+
+    if not len(found):
+        return {mov_stack: ([], data) for mov_stack in mov_stacks}
+    days = [str(day) for day in days]
+    dates = np.array(found, dtype="datetime64[D]")
+    start = dates.min()
+    index = (dates - start).astype(int)
+    # Index of every requested day, +1 as the cumulative sums start with 0
+    end = (np.array(days, dtype="datetime64[D]") - start).astype(int) + 1
+    span = max(index.max() + 1, end.max())
+
+    # Missing days are zero and not counted
+    sums = np.zeros((span + 1, data.shape[1]))
+    sums[index + 1] = data
+    np.cumsum(sums, axis=0, out=sums)
+    counts = np.zeros(span + 1)
+    counts[index + 1] = 1
+    np.cumsum(counts, out=counts)
+
+    stacks = {}
+    stop = np.clip(end, 0, span)
+    for mov_stack in mov_stacks:
+        begin = np.clip(end - mov_stack, 0, span)
+        ndays = counts[stop] - counts[begin]
+        keep = np.nonzero(ndays > 0)[0]
+        stacks[mov_stack] = (
+            [days[i] for i in keep],
+            (sums[stop[keep]] - sums[begin[keep]]) /
+            ndays[keep, np.newaxis])
+    return stacks
+
+
+class PairStacks(object):
+    """
+    The REF and day stacks of a pair, read in background threads in the
+    order the stretching uses them (filters, components, then mov_stacks).
+
+    At most ``depth`` stacks are read ahead and waiting to be used, which
+    bounds the memory. When a REF is missing, the day stacks of its filter
+    and component are not read.
+
+    With the ``daily`` ``mov_stack_source`` of the context, only the daily
+    (``001_DAYS``) stacks are read, once per filter and component, and all
+    the mov_stacks are built from them (see :func:`moving_stacks`).
+
+    :type executor: :class:`~concurrent.futures.ThreadPoolExecutor`
+    :param executor: The reader threads. None reads every stack when it
+                     is asked for.
+
+    :type context: :class:`~ms_stretch.context.RunContext`
+    :param context: Read-only parameters of the run.
+
+    :type pair: str
+    :param pair: The pair, as in the jobs (``NET.STA:NET.STA``).
+
+    :type days: list of str
+    :param days: The days to read (``YYYY-MM-DD``).
+
+    :type depth: int
+    :param depth: Number of stacks read ahead.
+    """
+
+    def __init__(self, executor, context, pair, days, depth=2):
+        self.executor = executor
+        self.depth = depth
+        self.extension = context.extension
+        self.mov_stacks = context.mov_stacks
+        self.daily = context.mov_stack_source == "daily"
+        # Paths of the day stacks read by the last call to days()
+        self.files = []
+        ref_name = pair.replace('.', '_').replace(':', '_')
+        self._days = days
+        self._tasks = OrderedDict()
+        self._futures = OrderedDict()
+        self._folders = {}
+        self._built = {}
+        if self.daily:
+            window = window_days(days, max(context.mov_stacks))
+        for filterid, _, _ in context.filters:
+            for components in context.components:
+                path = os.path.join("STACKS", "%02i" % filterid, "REF",
+                                    components, ref_name + context.extension)
+                self._tasks["ref", filterid, components] = \
+                    functools.partial(self._read_ref, path)
+                if self.daily:
+                    key = ("daily", filterid, components)
+                    self._folders[key] = os.path.join(
+                        "STACKS", "%02i" % filterid, "001_DAYS", components,
+                        ref_name)
+                    self._tasks[key] = functools.partial(
+                        load_days, self._folders[key], window,
+                        context.extension, threads=context.io_threads)
+                    continue
+                for mov_stack in context.mov_stacks:
+                    key = ("days", filterid, components, mov_stack)
+                    self._folders[key] = os.path.join(
+                        "STACKS", "%02i" % filterid, "%03i_DAYS" % mov_stack,
+                        components, ref_name)
+                    self._tasks[key] = functools.partial(
+                        load_days, self._folders[key], days,
+                        context.extension, threads=context.io_threads)
+        self._fill()
+
+    @staticmethod
+    def _read_ref(path):
+        if not os.path.isfile(path):
+            return None
+        return read_trace(path)
+
+    def _fill(self):
+        if self.executor is None:
+            return
+        while self._tasks and len(self._futures) < self.depth:
+            key, task = self._tasks.popitem(last=False)
+            self._futures[key] = self.executor.submit(task)
+
+    def _get(self, key):
+        if key in self._futures:
+            result = self._futures.pop(key).result()
+        else:
+            result = self._tasks.pop(key)()
+        self._fill()
+        return result
+
+    def ref(self, filterid, components):
+        """
+        The REF trace of a filter and component, None if there is no REF
+        file. In that case, its day stacks that are not being read yet are
+        dropped.
+        """
+
+        ref = self._get(("ref", filterid, components))
+        if ref is None:
+            for queue in (self._tasks, self._futures):
+                for key in [k for k in queue if k[0] != "ref" and
+                            k[1:3] == (filterid, components)]:
+                    task = queue.pop(key)
+                    if queue is self._futures:
+                        task.cancel()
+            self._fill()
+        return ref
+
+    def days(self, filterid, components, mov_stack):
+        """The found days and their traces, see :func:`load_days`."""
+        if self.daily:
+            if (filterid, components) in self._built:
+                self.files = []
+            else:
+                key = ("daily", filterid, components)
+                found, data = self._get(key)
+                self._read(key, found)
+                self._built[filterid, components] = moving_stacks(
+                    self._days, found, data, self.mov_stacks)
+            return self._built[filterid, components].pop(mov_stack)
+        key = ("days", filterid, components, mov_stack)
+        found, data = self._get(key)
+        self._read(key, found)
+        return found, data
+
+    def _read(self, key, found):
+        self.files = [os.path.join(self._folders[key], day + self.extension)
+                      for day in found]
+
+    def close(self):
+        """Drop the stacks that were not used."""
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        self._tasks.clear()
+        self._built.clear()
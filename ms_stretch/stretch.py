@@ -2,12 +2,105 @@
 Stretching...
 """
 
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    FIRST_COMPLETED, wait
+
 from msnoise.api import *
-from scipy import asarray as ar
-from scipy.optimize import curve_fit
-from scipy.ndimage import map_coordinates
 
-def stretch_mat_creation(refcc, str_range=0.01, nstr=1001):
+from .api import get_stretch_config
+from .cache import StretchCache, reference_key
+from .context import build_context, pair_windows
+from .results import ColumnarStore, write_results
+from .stacks import PairStacks
+from .layout import apply_layout, cpu_layout, describe
+from .jobs import backoff, claim_jobs, complete_jobs, has_pending_jobs, \
+    reclaim_expired
+from .profiling import Profiler, write_report
+from .references import update_references
+from scipy.ndimage import map_coordinates, spline_filter1d
+
+def stretch_coordinates(n, str_range=0.01, nstr=1001, center=None,
+                        rows=slice(None)):
+    """ Sample coordinates of the stretched instances of a trace.
+
+    Stretching a trace only depends on its length, the stretching range
+    and the number of steps. The coordinates are cheap to compute compared
+    to the interpolation, so they are computed for a block of rows at a
+    time instead of being kept for the whole ``(nstr, n)`` matrix.
+
+    :type n: int
+    :param n: Number of samples of the trace
+    :type str_range: float
+    :param str_range: Amount of the desired stretching (one side)
+    :type nstr: int
+    :param nstr: Number of stretching steps
+    :type center: int
+    :param center: Index of the zero lag sample, the middle of the trace by
+        default. It is 0 for one sided (e.g. folded) traces
+    :type rows: slice
+    :param rows: The stretching steps (rows) to compute, all by default
+
+    :rtype: :class:`~numpy.ndarray`
+    :return: 2d float64 ndarray of size ``(rows, n)``, row ``i`` holds the
+        sample positions in the reference trace of the ``i``-th stretched
+        trace
+    """
+
+    if center is None:
+        center = n // 2
+    samples_idx = np.arange(n) - center
+    strvec = (1 + np.linspace(-str_range, str_range, nstr))[::-1][rows]
+    return samples_idx[np.newaxis, :] / strvec[:, np.newaxis] + center
+
+
+def spline_coefficients(trace):
+    """ Cubic spline coefficients of a trace.
+
+    They are the input of the interpolation of every stretched instance of
+    the trace (see :func:`stretch_mat_creation`, :func:`stretch_traces`),
+    so they are computed once per trace instead of once per block of
+    stretched rows.
+
+    :type trace: :class:`~numpy.ndarray`
+    :param trace: 1d ndarray, the trace
+
+    :rtype: :class:`~numpy.ndarray`
+    :return: 1d float64 ndarray of the coefficients
+    """
+
+    return spline_filter1d(np.asarray(trace, dtype=np.float64), order=3,
+                           mode='mirror')
+
+
+def interpolate_trace(coeffs, coords, dtype=np.float64):
+    """ Cubic spline interpolation of a trace at arbitrary sample positions.
+
+    :type coeffs: :class:`~numpy.ndarray`
+    :param coeffs: 1d ndarray, spline coefficients of the trace as returned
+        by :func:`spline_coefficients`
+    :type coords: :class:`~numpy.ndarray`
+    :param coords: ndarray of sample positions, of any shape
+    :type dtype: :class:`~numpy.dtype`
+    :param dtype: Type of the output, the interpolation itself is always
+        computed in float64
+
+    :rtype: :class:`~numpy.ndarray`
+    :return: ndarray of the shape of ``coords``, 0 beyond the edges of the
+        trace
+    """
+
+    n = len(coeffs)
+    values = map_coordinates(coeffs, coords.reshape((1, -1)), output=dtype,
+                             prefilter=False, mode='mirror')
+    values = values.reshape(coords.shape)
+    # No interpolation beyond the edges of the trace
+    values[(coords < 0) | (coords > n - 1)] = 0.
+    return values
+
+
+def stretch_mat_creation(refcc, str_range=0.01, nstr=1001, center=None,
+                         dtype=np.float64, block=2 ** 22):
     """ Matrix of stretched instance of a reference trace.
 
     The reference trace is stretched using a cubic spline interpolation
@@ -17,38 +110,795 @@ def stretch_mat_creation(refcc, str_range=0.01, nstr=1001):
     of the reference trace (one each row) (``strrefmat``) and the corresponding
     stretching amount (`strvec```).
 
+    The spline coefficients of the trace are computed once (see
+    :func:`spline_coefficients`), then the rows are interpolated in blocks
+    with :func:`interpolate_trace`. The coordinates of a block (see
+    :func:`stretch_coordinates`) are computed on the fly, so that they
+    never take more memory than ``block`` float64 values. Several reference
+    traces can be passed at once as a 2d ndarray, in which case the
+    coordinates of a block are shared between them.
+
     :type refcc: :class:`~numpy.ndarray`
-    :param refcc: 1d ndarray. The reference trace that will be stretched
+    :param refcc: 1d ndarray. The reference trace that will be stretched.
+        Can also be a 2d ndarray with one reference trace per row.
     :type str_range: float
     :param str_range: Amount of the desired stretching (one side)
     :type nstr: int
     :param nstr: Number of stretching steps (one side)
+    :type center: int
+    :param center: Index of the zero lag sample, see
+        :func:`stretch_coordinates`
+    :type dtype: :class:`~numpy.dtype`
+    :param dtype: Type of the stretched traces. The spline interpolation
+        itself is always computed in float64
+    :type block: int
+    :param block: Maximum number of coordinates computed at once
 
     :rtype: :class:`~numpy.ndarray` and float
     :return: **strrefmat**:
         - 2d ndarray of stretched version of the reference trace.
-        Its size is ``(nstr,len(refcc)/2)`` if ``signle_side==True``
-        otherwise it is ``(nstr,len(refcc))``
+        Its size is ``(nstr,len(refcc))``. If ``refcc`` is 2d, the result
+        is a 3d ndarray of size ``(len(refcc),nstr,refcc.shape[1])``
     :rtype: float
     :return: **strvec**: List of float, stretch amount for each row
         of ``strrefmat``
     """
 
-    n = len(refcc)
-    samples_idx = np.arange(n) - n // 2
+    refcc = np.asarray(refcc, dtype=np.float64)
+    n = refcc.shape[-1]
     strvec = 1 + np.linspace(-str_range, str_range, nstr)
-    str_timemat = np.zeros((nstr, n))
-    for ii in np.arange(nstr):
-        str_timemat[ii, :] = samples_idx / strvec[nstr - 1 - ii]
-    strrefmat = np.zeros_like(str_timemat)
-    coord = np.zeros((2, n))
-    for (i, row) in enumerate(str_timemat):
-        coord[0, :] = row + n // 2
-        strrefmat[i, :] = map_coordinates(refcc.reshape((len(refcc), 1)), coord)
+    splines = [spline_coefficients(trace) for trace in np.atleast_2d(refcc)]
+    strrefmat = np.empty((len(splines), nstr, n), dtype=dtype)
+    rows = max(1, block // n)
+    for start in range(0, nstr, rows):
+        sl = slice(start, start + rows)
+        coords = stretch_coordinates(n, str_range, nstr, center, sl)
+        for i, spline in enumerate(splines):
+            strrefmat[i, sl] = interpolate_trace(spline, coords, dtype)
+    if refcc.ndim == 1:
+        strrefmat = strrefmat[0]
     return strrefmat, strvec
 
 
-def main():
+def stretch_memory(n, nstr, dtype=np.float64, block=2 ** 22):
+    """ Peak memory of building a normalized stretched reference.
+
+    :func:`stretch_mat_creation` holds the stretched traces and one block of
+    float64 coordinates, then :func:`normalize_traces` makes a normalized
+    copy of the traces.
+
+    :type n: int
+    :param n: Number of samples of the reference trace
+    :type nstr: int
+    :param nstr: Number of stretching steps
+    :type dtype: :class:`~numpy.dtype`
+    :param dtype: Type of the stretched traces
+    :type block: int
+    :param block: Maximum number of coordinates computed at once, see
+        :func:`stretch_mat_creation`
+
+    :rtype: int
+    :return: The memory in bytes
+    """
+
+    return nstr * n * 2 * np.dtype(dtype).itemsize + min(nstr * n, block) * 8
+
+
+def normalize_traces(traces, dtype=np.float64):
+    """ Remove the mean of each trace and scale it to unit norm.
+
+    Once normalized, the Pearson correlation coefficient of two traces is
+    simply their dot product, which allows to correlate many traces at once
+    with a single matrix product (see :func:`correlation_matrix`).
+    Traces that are zero everywhere come out as NaN, just like with
+    :func:`numpy.corrcoef`.
+
+    :type traces: :class:`~numpy.ndarray`
+    :param traces: 1d or 2d ndarray, one trace per row
+    :type dtype: :class:`~numpy.dtype`
+    :param dtype: Type of the normalized traces. The means and norms are
+        always accumulated in float64
+
+    :rtype: :class:`~numpy.ndarray`
+    :return: 2d ndarray of normalized traces, one per row
+    """
+
+    traces = np.array(np.atleast_2d(traces), dtype=dtype)
+    traces -= traces.mean(axis=1, dtype=np.float64,
+                          keepdims=True).astype(dtype)
+    if traces.dtype == np.float64:
+        norms = np.sqrt(np.einsum('ij,ij->i', traces, traces))
+    else:
+        norms = np.sqrt(np.square(traces).sum(axis=1, dtype=np.float64))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        traces /= norms[:, None]
+    return traces
+
+
+def dot_rows(a, b, block=4096):
+    """ Dot products of all the rows of two matrices, ``a @ b.T``.
+
+    float64 matrices are multiplied at once. Lower precision matrices are
+    multiplied in blocks of samples, the partial products being summed in
+    float64, so that the rounding errors do not grow with the length of
+    the traces.
+
+    :type a: :class:`~numpy.ndarray`
+    :param a: 2d ndarray (m x samples)
+    :type b: :class:`~numpy.ndarray`
+    :param b: 2d ndarray (k x samples), same type as ``a``
+    :type block: int
+    :param block: Number of samples per block
+
+    :rtype: :class:`~numpy.ndarray`
+    :return: 2d float64 ndarray (m x k)
+    """
+
+    if a.dtype == np.float64:
+        return np.dot(a, b.T)
+    out = np.zeros((len(a), len(b)))
+    for start in range(0, a.shape[1], block):
+        sl = slice(start, start + block)
+        out += np.dot(a[:, sl], b[:, sl].T)
+    return out
+
+
+def correlation_matrix(curs, ref_norm):
+    """ Correlation coefficients of many traces against a stretched reference.
+
+    The current traces are normalized to the type of ``ref_norm``, so a
+    float32 reference gives a float32 matrix product (see
+    :func:`dot_rows`).
+
+    :type curs: :class:`~numpy.ndarray`
+    :param curs: 2d ndarray (days x samples) of the current traces
+    :type ref_norm: :class:`~numpy.ndarray`
+    :param ref_norm: 2d ndarray (nstr x samples) of the stretched reference
+        traces, already normalized with :func:`normalize_traces`
+
+    :rtype: :class:`~numpy.ndarray`
+    :return: 2d float64 ndarray (days x nstr), entry ``[i, j]`` is the
+        correlation coefficient of day ``i`` with the ``j``-th stretched
+        reference
+    """
+
+    return dot_rows(normalize_traces(curs, dtype=ref_norm.dtype), ref_norm)
+
+
+def tiled_correlation_matrix(curs, ref, str_range=0.01, nstr=1001,
+                             center=None, dtype=np.float64,
+                             budget=256 * 1024 ** 2):
+    """ Memory bounded version of :func:`correlation_matrix`.
+
+    The stretched reference is never built in full: tiles of stretching
+    steps are interpolated, normalized and correlated with the days one
+    after the other, so that the stretched reference takes at most
+    ``budget``. The days are normalized once beforehand, their normalized
+    copy is not counted in the budget as it is not larger than the days
+    themselves. Each tile is computed exactly like the corresponding rows
+    of :func:`stretch_mat_creation`, so the coefficients are the same as
+    with the full matrix, up to the rounding of the matrix products.
+
+    :type curs: :class:`~numpy.ndarray`
+    :param curs: 2d ndarray (days x samples) of the current traces
+    :type ref: :class:`~numpy.ndarray`
+    :param ref: 1d ndarray. The reference trace
+    :type str_range: float
+    :param str_range: Amount of the desired stretching (one side)
+    :type nstr: int
+    :param nstr: Number of stretching steps
+    :type center: int
+    :param center: Index of the zero lag sample, see
+        :func:`stretch_coordinates`
+    :type dtype: :class:`~numpy.dtype`
+    :param dtype: Type of the stretched and normalized tiles
+    :type budget: int
+    :param budget: Memory (in bytes) the tiles of steps may use
+
+    :rtype: :class:`~numpy.ndarray`
+    :return: 2d float64 ndarray (days x nstr) of the correlation
+        coefficients
+    """
+
+    ref = np.asarray(ref, dtype=np.float64)
+    n = len(ref)
+    if center is None:
+        center = n // 2
+    itemsize = np.dtype(dtype).itemsize
+    # A tile of steps holds its coordinates, stretched and normalized rows
+    steps_tile = int(max(1, budget // (n * (8 + 2 * itemsize))))
+
+    curs = normalize_traces(curs, dtype=dtype)
+    spline = spline_coefficients(ref)
+    coeffs = np.empty((len(curs), nstr))
+    for start in range(0, nstr, steps_tile):
+        sl = slice(start, start + steps_tile)
+        coords = stretch_coordinates(n, str_range, nstr, center, sl)
+        ref_norm = normalize_traces(interpolate_trace(spline, coords, dtype),
+                                    dtype=dtype)
+        del coords
+        coeffs[:, sl] = dot_rows(curs, ref_norm)
+    return coeffs
+
+
+def stretch_traces(coeffs, deltas, center=None):
+    """ Stretched instances of a trace for arbitrary stretch amounts.
+
+    Same interpolation and stretching convention as
+    :func:`stretch_mat_creation`, but the stretch amounts do not have to
+    lie on a regular grid. The spline coefficients of the trace are passed
+    directly so that they can be computed once and reused for many calls.
+
+    :type coeffs: :class:`~numpy.ndarray`
+    :param coeffs: 1d ndarray, cubic spline coefficients of the trace as
+        returned by :func:`spline_coefficients`
+    :type deltas: :class:`~numpy.ndarray`
+    :param deltas: ndarray of stretch amounts, of any shape
+    :type center: int
+    :param center: Index of the zero lag sample, see
+        :func:`stretch_coordinates`
+
+    :rtype: :class:`~numpy.ndarray`
+    :return: ndarray of size ``deltas.shape + (len(coeffs),)`` with one
+        stretched trace per stretch amount
+    """
+
+    n = len(coeffs)
+    if center is None:
+        center = n // 2
+    deltas = np.asarray(deltas, dtype=np.float64)
+    samples_idx = np.arange(n) - center
+    coords = samples_idx[np.newaxis, :] / (2 - deltas.reshape((-1, 1))) + \
+        center
+    return interpolate_trace(coeffs, coords).reshape(deltas.shape + (n,))
+
+
+def hierarchical_search(curs, ref, str_range=0.01, nstr=101, fine_nstr=21,
+                        max_widen=2, cache=None, center=None,
+                        dtype=np.float64):
+    """ Coarse-to-fine search of the best stretching of many traces.
+
+    The traces are first correlated with a coarse grid of ``nstr`` stretched
+    versions of the reference. If the best coefficient of a trace lies on
+    the edge of the grid, the range is doubled for that trace (at most
+    ``max_widen`` times). A finer local grid of ``fine_nstr`` steps is then
+    evaluated between the neighbours of the best coarse step, and the peak
+    is finally refined with a parabolic interpolation of the best fine step
+    and its neighbours.
+
+    :type curs: :class:`~numpy.ndarray`
+    :param curs: 2d ndarray (days x samples) of the current traces
+    :type ref: :class:`~numpy.ndarray`
+    :param ref: 1d ndarray. The reference trace
+    :type str_range: float
+    :param str_range: Amount of the desired stretching (one side)
+    :type nstr: int
+    :param nstr: Number of stretching steps of the coarse grid
+    :type fine_nstr: int
+    :param fine_nstr: Number of stretching steps of the local fine grid
+    :type max_widen: int
+    :param max_widen: How often the range can be doubled if the peak lies
+        on its edge
+    :type cache: :class:`~ms_stretch.cache.StretchCache`
+    :param cache: Optional cache for the coarse and fine stretched
+        references
+    :type center: int
+    :param center: Index of the zero lag sample, see
+        :func:`stretch_coordinates`
+    :type dtype: :class:`~numpy.dtype`
+    :param dtype: Type of the coarse grid computation, the fine grid is
+        always computed in float64
+
+    :rtype: :class:`~numpy.ndarray`
+    :return: **coeffs**: 2d ndarray (days x nstr) of the coarse coefficients
+    :rtype: :class:`~numpy.ndarray`
+    :return: **ranges**: 1d ndarray, the stretching range used per day
+    :rtype: :class:`~numpy.ndarray`
+    :return: **best_deltas**: 1d ndarray, the refined stretch amount per day
+    :rtype: :class:`~numpy.ndarray`
+    :return: **best_coeffs**: 1d ndarray, the refined coefficient per day
+    """
+
+    def stretched_reference(str_range):
+        builder = lambda: normalize_traces(stretch_mat_creation(
+            ref, str_range=str_range, nstr=nstr, center=center,
+            dtype=dtype)[0], dtype=dtype)
+        if cache is None:
+            return builder()
+        return cache.get(reference_key(ref, str_range, nstr, center, dtype),
+                         builder)
+
+    curs = normalize_traces(curs)
+    coarse_curs = curs.astype(dtype, copy=False)
+    ndays = len(curs)
+    coeffs = np.zeros((ndays, nstr))
+    ranges = np.full(ndays, float(str_range))
+
+    if not ndays:
+        return coeffs, ranges, np.zeros(0), np.zeros(0)
+
+    # Coarse grid, widened for the days whose peak is on the edge
+    todo = np.arange(ndays)
+    for widen in range(max_widen + 1):
+        ranges[todo] = str_range * 2 ** widen
+        coeffs[todo] = dot_rows(coarse_curs[todo],
+                                stretched_reference(ranges[todo[0]]))
+        imax = np.argmax(coeffs[todo], axis=1)
+        best = coeffs[todo, imax]
+        todo = todo[((imax == 0) | (imax == nstr - 1)) & ~np.isnan(best)]
+        if not len(todo):
+            break
+        if widen < max_widen:
+            logging.debug("Peak on the edge of the stretching range for %i "
+                          "days, widening it" % len(todo))
+
+    # Local fine grid between the neighbours of the best coarse step. It only
+    # depends on the range and the best coarse step, which most days share,
+    # so it is built (or taken from the cache) once per group of days
+    steps = 2 * ranges / (nstr - 1)
+    imax = np.argmax(coeffs, axis=1)
+    centers = 1 - ranges + imax * steps
+    fine_steps = 2 * steps / (fine_nstr - 1)
+    fine_deltas = centers[:, np.newaxis] + \
+        np.linspace(-1, 1, fine_nstr)[np.newaxis, :] * steps[:, np.newaxis]
+
+    spline = []
+
+    def fine_reference(day):
+        def builder():
+            if not spline:
+                spline.append(spline_coefficients(ref))
+            return normalize_traces(stretch_traces(
+                spline[0], fine_deltas[day], center))
+        if cache is None:
+            return builder()
+        return cache.get(reference_key(ref, ranges[day], nstr, center,
+                                       local=(imax[day], fine_nstr)),
+                         builder)
+
+    fine = np.zeros((ndays, fine_nstr))
+    groups = np.unique(np.stack((ranges, imax)), axis=1,
+                       return_inverse=True)[1].ravel()
+    for group in np.unique(groups):
+        members = np.flatnonzero(groups == group)
+        fine[members] = dot_rows(curs[members], fine_reference(members[0]))
+
+    # Parabolic interpolation of the peak
+    jmax = np.argmax(fine, axis=1)
+    days = np.arange(ndays)
+    best_deltas = fine_deltas[days, jmax]
+    best_coeffs = fine[days, jmax]
+    inner = (jmax > 0) & (jmax < fine_nstr - 1)
+    y0 = best_coeffs[inner]
+    ym = fine[days[inner], jmax[inner] - 1]
+    yp = fine[days[inner], jmax[inner] + 1]
+    curvature = ym - 2 * y0 + yp
+    with np.errstate(invalid='ignore', divide='ignore'):
+        offset = np.where(curvature < 0, 0.5 * (ym - yp) / curvature, 0.)
+    best_deltas[inner] += offset * fine_steps[inner]
+    best_coeffs[inner] = y0 - 0.25 * (ym - yp) * offset
+
+    return coeffs, ranges, best_deltas, best_coeffs
+
+
+def peak_width_error(coeffs, steps):
+    """ Error of the stretching from the width of the correlation peak.
+
+    The error is the half width at half maximum of the coefficients around
+    their peak, after shifting them so that their minimum is zero. The
+    crossings of the half maximum are linearly interpolated between steps.
+    If the curve does not drop below the half maximum on one side of the
+    peak, the width of the other side is used instead. It is computed for
+    all days at once, replacing the Gaussian fit done for every day before.
+
+    :type coeffs: :class:`~numpy.ndarray`
+    :param coeffs: 2d ndarray (days x nstr) of correlation coefficients
+    :type steps: :class:`~numpy.ndarray`
+    :param steps: Stretch amount between two columns of ``coeffs``, one
+        value per day or a float
+
+    :rtype: :class:`~numpy.ndarray`
+    :return: 1d ndarray of the errors in dv/v units (NaN if the peak
+        cannot be found)
+    """
+
+    coeffs = np.atleast_2d(coeffs)
+    ndays, nstr = coeffs.shape
+    days = np.arange(ndays)
+    idx = np.arange(nstr)[np.newaxis, :]
+    imax = np.argmax(coeffs, axis=1)
+    half = (coeffs[days, imax] + coeffs.min(axis=1, initial=np.inf)) / 2
+    below = coeffs < half[:, np.newaxis]
+
+    # Last step below the half maximum left of the peak, first one right
+    left = np.where(below & (idx < imax[:, np.newaxis]), idx, -1).max(
+        axis=1, initial=-1)
+    right = np.where(below & (idx > imax[:, np.newaxis]), idx, nstr).min(
+        axis=1, initial=nstr)
+    has_left = left >= 0
+    has_right = right < nstr
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        y1 = coeffs[days, np.clip(left, 0, nstr - 1)]
+        y2 = coeffs[days, np.clip(left + 1, 0, nstr - 1)]
+        half_left = imax - (left + (half - y1) / (y2 - y1))
+        y1 = coeffs[days, np.clip(right - 1, 0, nstr - 1)]
+        y2 = coeffs[days, np.clip(right, 0, nstr - 1)]
+        half_right = right - 1 + (y1 - half) / (y1 - y2) - imax
+
+    half_left = np.where(has_left, half_left, half_right)
+    half_right = np.where(has_right, half_right, half_left)
+    hwhm = np.where(has_left | has_right, (half_left + half_right) / 2,
+                    np.nan)
+    return hwhm * steps
+
+
+def theoretical_error(coeffs, fmin, fmax, tmin, tmax):
+    """ Theoretical error of the stretching method.
+
+    Root mean square error of the stretching estimate from the correlation
+    coefficient of the best stretching, the frequency band and the lag time
+    window (Weaver et al., 2011, GJI, eq. 3).
+
+    :type coeffs: :class:`~numpy.ndarray`
+    :param coeffs: 1d ndarray, best correlation coefficient per day
+    :type fmin: float
+    :param fmin: Lower frequency bound of the filter (Hz)
+    :type fmax: float
+    :param fmax: Higher frequency bound of the filter (Hz)
+    :type tmin: float
+    :param tmin: Start of the lag time window (s)
+    :type tmax: float
+    :param tmax: End of the lag time window (s)
+
+    :rtype: :class:`~numpy.ndarray`
+    :return: 1d ndarray of the errors in dv/v units (NaN where the
+        coefficient is not positive)
+    """
+
+    coeffs = np.asarray(coeffs, dtype=np.float64)
+    T = 1. / (fmax - fmin)
+    omega = 2 * np.pi * (fmin + fmax) / 2.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        error = np.sqrt(1 - coeffs ** 2) / (2 * coeffs) * \
+            np.sqrt(6 * np.sqrt(np.pi / 2) * T /
+                    (omega ** 2 * (tmax ** 3 - tmin ** 3)))
+    return np.where(coeffs > 0, error, np.nan)
+
+
+# Read-only run context, cache and profiler of the current worker process,
+# set up by init_worker
+_context = None
+_cache = None
+_profiler = Profiler()
+# Threads reading the stacks ahead of their use, None if prefetch is 0
+_reader = None
+
+
+def window_mask(n, mid, samples):
+    """ Mask keeping only the lag time window of a trace.
+
+    :type n: int
+    :param n: Number of samples of the trace
+    :type mid: int
+    :param mid: Index of the zero lag sample
+    :type samples: tuple of int
+    :param samples: ``(start, stop)`` indices of the causal side of the
+        window, see :class:`~ms_stretch.context.PairWindow`
+
+    :rtype: :class:`~numpy.ndarray`
+    :return: 1d ndarray, 1 inside the window (both sides) and 0 outside
+    """
+
+    start, stop = samples
+    mask = np.zeros(n)
+    mask[max(0, 2 * mid - stop):max(0, 2 * mid - start)] = 1.
+    mask[start:stop] = 1.
+    return mask
+
+
+def side_traces(traces, mid, side):
+    """ Lag side of traces to stretch.
+
+    The one sided traces start at zero lag, the acausal side being reversed
+    so that its lags are positive too. Folding (``symmetric``) averages
+    both sides, which halves the number of samples to stretch and
+    correlate.
+
+    :type traces: :class:`~numpy.ndarray`
+    :param traces: 1d or 2d ndarray, one trace per row
+    :type mid: int
+    :param mid: Index of the zero lag sample
+    :type side: str
+    :param side: ``causal``, ``acausal``, ``both`` or ``symmetric``
+
+    :rtype: :class:`~numpy.ndarray`
+    :return: **traces**: The lag side of the traces (a view if possible)
+    :rtype: int
+    :return: **center**: Index of the zero lag sample in the returned traces
+    """
+
+    if side == "both":
+        return traces, mid
+    causal = traces[..., mid:]
+    acausal = traces[..., mid::-1]
+    if side == "causal":
+        return causal, 0
+    if side == "acausal":
+        return acausal, 0
+    n = min(causal.shape[-1], acausal.shape[-1])
+    return (causal[..., :n] + acausal[..., :n]) / 2., 0
+
+
+def init_worker(context, profile=False, layout=None, counter=None):
+    """ Set up a process computing the stretching.
+
+    :type context: :class:`~ms_stretch.context.RunContext`
+    :param context: Read-only parameters of the run, shared by all workers
+    :type profile: bool
+    :param profile: Time the stages of the computation, see
+        :class:`~ms_stretch.profiling.Profiler`
+    :type layout: :class:`~ms_stretch.layout.CpuLayout`
+    :param layout: BLAS threads and cores of the workers
+    :type counter: :class:`multiprocessing.Value`
+    :param counter: Shared counter giving every worker its index in the
+        layout
+    """
+
+    global _context, _cache, _profiler, _reader
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s [%(levelname)s] %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    _context = context
+    _cache = StretchCache(memory=context.cache_memory,
+                          folder=context.cache_dir,
+                          folder_size=context.cache_dir_size)
+    _profiler = Profiler(profile)
+    if layout is not None:
+        index = 0
+        if counter is not None:
+            with counter.get_lock():
+                index = counter.value
+                counter.value += 1
+        if not apply_layout(layout, index):
+            logging.debug("threadpoolctl is not installed, the BLAS threads "
+                          "are only limited through environment variables")
+    if context.prefetch > 0:
+        _reader = ThreadPoolExecutor(max_workers=context.prefetch)
+
+
+def prefetch_pair(pair, days):
+    """ Start reading the stacks of a pair in the background threads of the
+    worker, see :class:`~ms_stretch.stacks.PairStacks`. :func:`init_worker`
+    must have been called before.
+
+    :type pair: str
+    :param pair: The pair, as in the jobs (``NET.STA:NET.STA``)
+    :type days: list of str
+    :param days: The days to read (``YYYY-MM-DD``)
+
+    :rtype: :class:`~ms_stretch.stacks.PairStacks`
+    :return: The stacks, to give to :func:`compute_pair`
+    """
+
+    return PairStacks(_reader, _context, pair, days, depth=_context.prefetch)
+
+
+def compute_pair(pair, days, windows, stacks=None):
+    """ Stretching of some days of a pair for all filters, components,
+    mov_stacks, lag sides and lag time windows. :func:`init_worker` must
+    have been called before.
+
+    Every REF and day stack is read once, all the lag sides and lag time
+    windows are then cut from the same traces in memory. The next stacks
+    are read in the background while the current ones are computed.
+
+    :type pair: str
+    :param pair: The pair, as in the jobs (``NET.STA:NET.STA``)
+    :type days: list of str
+    :param days: The days to compute (``YYYY-MM-DD``)
+    :type windows: tuple of :class:`~ms_stretch.context.PairWindow`
+    :param windows: The lag time windows of the pair
+    :type stacks: :class:`~ms_stretch.stacks.PairStacks`
+    :param stacks: The stacks of the pair if their reading was already
+        started with :func:`prefetch_pair`
+
+    :rtype: dict
+    :return: The ``pair``, the ``results`` as a list of
+        ``(filterid, lag, side, mov_stack, components, df, mat)`` tuples,
+        and the ``pid``, ``cache`` statistics and ``profile`` report of the
+        worker. ``lag`` is
+        the :class:`~ms_stretch.context.LagWindow` and ``side`` the lag
+        side (see :func:`side_traces`) of the results, ``mat`` is
+        the ``(coeffs, deltas)`` coefficient matrix and its stretch axis if
+        the ``str_mat`` setting asks for it, else None
+    """
+
+    c = _context
+    extension = c.extension
+    str_range = c.str_range
+    nstr = c.nstr
+    search = c.search
+    coarse_nstr = c.coarse_nstr
+    dtype = np.dtype(c.precision)
+    budget = c.memory_budget
+    mid = int(c.goal_sampling_rate * c.maxlag)
+    deltas = 1 + np.linspace(-str_range, str_range, nstr)
+    ref_name = pair.replace('.', '_').replace(':', '_')
+    results = []
+    if stacks is None:
+        stacks = prefetch_pair(pair, days)
+
+    for filterid, low, high in c.filters:
+        # The stretched REF does not depend on the mov_stack, only
+        # build it once per component and window (or reuse it from the
+        # cache)
+        for components in c.components:
+            rf = os.path.join("STACKS", "%02i" %
+                              filterid, "REF", components, ref_name + extension)
+            with _profiler.stage("read_ref"):
+                fullref = stacks.ref(filterid, components)
+            if fullref is None:
+                logging.debug(
+                    "No REF file named %s, skipping." % rf)
+                continue
+            _profiler.count("traces_read")
+
+            # Stretched REF of every side and window, keyed by their index
+            masks = {}
+            refs = {}
+            refs_norm = {}
+            tiled = {}
+            # Zero lag sample of the stretched traces, None for the middle
+            # (which keeps the cache keys of earlier versions)
+            centers = {}
+            for k, side in enumerate(c.sides):
+                with _profiler.stage("mask"):
+                    sideref, center = side_traces(fullref, mid, side)
+                centers[k] = None if side == "both" else center
+                for i, window in enumerate(windows):
+                    # replace with zeroes at all times outside minlag to
+                    # maxlag
+                    start, stop = window.samples
+                    with _profiler.stage("mask"):
+                        mask = window_mask(len(sideref), center,
+                                           (start - mid + center,
+                                            stop - mid + center))
+                        ref = sideref * mask
+                    masks[k, i] = mask
+                    refs[k, i] = ref
+                    # Stretched references that can not be built within
+                    # the budget are correlated tile by tile instead
+                    tiled[k, i] = budget and \
+                        stretch_memory(len(ref), nstr, dtype) > budget
+                    if search != "hierarchical" and not tiled[k, i]:
+                        with _profiler.stage("stretch_ref"):
+                            refs_norm[k, i] = _cache.get(
+                                reference_key(ref, str_range, nstr,
+                                              centers[k], dtype),
+                                lambda: normalize_traces(stretch_mat_creation(
+                                    ref, str_range=str_range, nstr=nstr,
+                                    center=center, dtype=dtype)[0],
+                                    dtype=dtype))
+
+            for mov_stack in c.mov_stacks:
+                with _profiler.stage("read_days"):
+                    found, traces = stacks.days(filterid, components,
+                                                mov_stack)
+                # The daily stacks are only read for the first mov_stack
+                _profiler.count("traces_read", len(stacks.files))
+                if _profiler.enabled:
+                    _profiler.count("bytes_read", sum(
+                        os.path.getsize(path) for path in stacks.files))
+                logging.debug(
+                    'Processing Stretching for: %s.%s.%02i - %i days - %02i days' %
+                    (ref_name, components, filterid, len(found), mov_stack))
+                alldays = [datetime.datetime.strptime(day, "%Y-%m-%d")
+                           for day in found]
+                if not len(found):
+                    traces = np.empty((0, len(fullref)))
+
+                for k, side in enumerate(c.sides):
+                    with _profiler.stage("mask"):
+                        sidetraces = side_traces(traces, mid, side)[0]
+                    for i, window in enumerate(windows):
+                        with _profiler.stage("mask"):
+                            curs = sidetraces * masks[k, i]
+                        if search == "hierarchical":
+                            with _profiler.stage("search"):
+                                allcoeffs, ranges, alldeltas, allcoefs = \
+                                    hierarchical_search(
+                                        curs, refs[k, i],
+                                        str_range=str_range,
+                                        nstr=coarse_nstr,
+                                        fine_nstr=c.fine_nstr,
+                                        max_widen=c.max_widen,
+                                        cache=_cache, center=centers[k],
+                                        dtype=dtype)
+                            steps = 2 * ranges / (coarse_nstr - 1)
+                            _profiler.count("correlations", len(found) *
+                                            (coarse_nstr + c.fine_nstr))
+                        else:
+                            # All days of this pair in one days x nstr matrix
+                            with _profiler.stage("correlate"):
+                                if tiled[k, i]:
+                                    allcoeffs = tiled_correlation_matrix(
+                                        curs, refs[k, i],
+                                        str_range=str_range, nstr=nstr,
+                                        center=centers[k], dtype=dtype,
+                                        budget=budget)
+                                else:
+                                    allcoeffs = correlation_matrix(
+                                        curs, refs_norm[k, i])
+                                imax = np.argmax(allcoeffs, axis=1)
+                            alldeltas = deltas[imax]
+                            allcoefs = allcoeffs[np.arange(len(imax)), imax]
+                            steps = 2 * str_range / (nstr - 1)
+                            _profiler.count("correlations", allcoeffs.size)
+
+                        with _profiler.stage("errors"):
+                            allerrs = peak_width_error(allcoeffs, steps)
+                            alltheos = theoretical_error(allcoefs, low, high,
+                                                         window.minlag,
+                                                         window.maxlag)
+                        _profiler.count("days", len(found))
+                        if _profiler.enabled:
+                            # Days without a well defined correlation peak
+                            _profiler.count("fits_failed",
+                                            int(np.isnan(allerrs).sum()))
+
+                        df = pd.DataFrame(np.array([alldeltas,allcoefs,allerrs,alltheos]).T, index=alldays, columns=["Delta", "Coeff", "Error", "TheoError"],)
+                        mat = None
+                        if c.str_mat != "none" and search == "hierarchical":
+                            # Days with a widened range are resampled on the
+                            # common coarse axis
+                            axis = 1 + np.linspace(-str_range, str_range,
+                                                   coarse_nstr)
+                            for j in np.nonzero(ranges != str_range)[0]:
+                                allcoeffs[j] = np.interp(
+                                    axis, 1 + np.linspace(-ranges[j],
+                                                          ranges[j],
+                                                          coarse_nstr),
+                                    allcoeffs[j])
+                            mat = (allcoeffs, axis)
+                        elif c.str_mat != "none":
+                            mat = (allcoeffs, deltas)
+                        results.append((filterid, window.lag, side,
+                                        mov_stack, components, df, mat))
+    stacks.close()
+
+    return {"pair": pair, "results": results, "pid": os.getpid(),
+            "cache": _cache.stats(), "profile": _profiler.report()}
+
+
+def main(threads=1, profile=None, report_interval=60., cores=None,
+         blas_threads=None, pin=False):
+    """ Compute the stretching of all pending STR (MWCS) jobs.
+
+    This process claims the jobs and hands them, one pair at a time, to a
+    pool of ``threads`` worker processes. The results are written by a
+    background thread of this process, and the jobs flagged as done by this
+    process only, once their results are written.
+
+    :type threads: int
+    :param threads: Number of worker processes. With 1, everything is
+        computed in the current process.
+    :type profile: str
+    :param profile: JSON file of the profiling report (see
+        :mod:`~ms_stretch.profiling`). None disables the profiling.
+    :type report_interval: float
+    :param report_interval: Interval (in s) between updates of the
+        profiling report during the run, it is also written at the end.
+    :type cores: int
+    :param cores: Budget of CPU cores of the run, all available cores by
+        default, see :func:`~ms_stretch.layout.cpu_layout`
+    :type blas_threads: int
+    :param blas_threads: BLAS threads of every worker, by default the
+        budget of cores divided by the number of workers
+    :type pin: bool
+    :param pin: Pin every worker to its own cores
+    """
+
     logging.basicConfig(level=logging.DEBUG,
                         format='%(asctime)s [%(levelname)s] %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
@@ -56,168 +906,207 @@ def main():
     logging.info('*** Starting: Compute STR ***')
 
     db = connect()
-    components_to_compute = get_components_to_compute(db)
+    start = time.time()
+    profiler = Profiler(profile is not None)
+    last_report = start
 
-    mov_stack = get_config(db, "mov_stack")
-    if mov_stack.count(',') == 0:
-        mov_stacks = [int(mov_stack), ]
-    else:
-        mov_stacks = [int(mi) for mi in mov_stack.split(',')]
-    params = get_params(db)
-    goal_sampling_rate = float(get_config(db, "cc_sampling_rate"))
-    maxlag = float(get_config(db, "maxlag"))
-    export_format = get_config(db, 'export_format')
-    if export_format == "BOTH":
-        extension = ".MSEED"
-    else:
-        extension = "."+export_format
-
-    # First we reset all DTT jobs to "T"odo if the REF is new for a given pair
-    # for station1, station2 in get_station_pairs(db, used=True):
-    #     sta1 = "%s.%s" % (station1.net, station1.sta)
-    #     sta2 = "%s.%s" % (station2.net, station2.sta)
-    #     pair = "%s:%s" % (sta1, sta2)
-    #     if is_dtt_next_job(db, jobtype='DTT', ref=pair):
-    #         logging.info(
-    #           "We will recompute all STR based on the new REF for %s" % pair)
-    #         reset_dtt_jobs(db, pair)
-    #         update_job(db, "REF", pair, jobtype='DTT', flag='D')
-
-    filters = get_filters(db, all=False)
-    params = get_params(db)
-    str_range = params.stretching_max
-    nstr = params.stretching_nsteps
-    # Then we compute the jobs
-    while is_dtt_next_job(db, flag='T', jobtype='MWCS'):
-        jobs = get_dtt_next_job(db, flag='T', jobtype='MWCS')
-
-        if not len(jobs):
-            # edge case, should only occur when is_next returns true, but
-            # get_next receives no jobs (heavily parallelised calls).
-            time.sleep(np.random.random())
-            continue
-        pair = jobs[0].pair
-        refs, days = zip(*[[job.ref, job.day] for job in jobs])
-
-        logging.info(
-            "There are STR (MWCS) jobs for some days to recompute for %s" % pair)
-
-        ref_name = pair.replace('.', '_').replace(':', '_')
-        sta1, sta2 = pair.split(':')
-        station1 = sta1.split(".")
-        station2 = sta2.split(".")
-
-        station1 = get_station(db, station1[0], station1[1])
-        station2 = get_station(db, station2[0], station2[1])
-
-        dtt_lag = get_config(db, "dtt_lag")
-        dtt_v = float(get_config(db, "dtt_v"))
-        dtt_minlag = float(get_config(db, "dtt_minlag"))
-        dtt_width = float(get_config(db, "dtt_width"))
-        dtt_sides = get_config(db, "dtt_sides")
-
-        if dtt_lag == "static":
-            minlag = dtt_minlag
-        else:
-            minlag = get_interstation_distance(station1, station2, station1.coordinates) / dtt_v
-
-        maxlag2 = minlag + dtt_width
-        print("betweeen", minlag, "and", maxlag2)
-
-        for f in get_filters(db, all=False):
-            filterid = int(f.ref)
-
-            for mov_stack in mov_stacks:
-                for components in params.all_components:
-                        rf = os.path.join("STACKS", "%02i" %
-                                          filterid, "REF", components, ref_name + extension)
-                        if os.path.isfile(rf):
-                            ref = read(rf)[0].data
-                            mid = int(goal_sampling_rate*maxlag)
-                            ref[mid-int(minlag*goal_sampling_rate):mid+int(minlag*goal_sampling_rate)] *= 0.
-                            ref[:mid-int(maxlag2*goal_sampling_rate)] *= 0.
-                            ref[mid+int(maxlag2*goal_sampling_rate):] *= 0.
-                        else:
-                            logging.debug(
-                                "No REF file named %s, skipping." % rf)
-                            continue
-                        alldays = []
-                        alldeltas = []
-                        allcoefs = []
-                        allerrs = []
-
-                        ref_stretched, deltas = stretch_mat_creation(ref,
-                                                                     str_range=str_range,
-                                                                     nstr=nstr)
-                        for day in days:
-                            df = os.path.join(
-                                "STACKS", "%02i" % filterid, "%03i_DAYS" %
-                                mov_stack, components, ref_name, str(day) + extension)
-
-                            if os.path.isfile(df):
-                                cur = read(df)[0].data   ### read the current mseed file ###
-                                cur[mid-int(minlag*goal_sampling_rate):mid+int(minlag*goal_sampling_rate)] *= 0.
-                                cur[:mid-int(maxlag2*goal_sampling_rate)] *= 0.
-                                cur[mid+int(maxlag2*goal_sampling_rate):] *= 0.  ### replace with zeroes at all
-                                                                                 ### times outside minlag to maxlag
-                                logging.debug(
-                                    'Processing Stretching for: %s.%s.%02i - %s - %02i days' %
-                                    (ref_name, components, filterid, day, mov_stack))
-
-                                coeffs =[]
-                                for i in range(ref_stretched.shape[0]):
-                                    ci = np.corrcoef(cur,ref_stretched[i])[0,1]
-                                    coeffs.append(ci)
-
-                                tday = datetime.datetime.strptime(day, "%Y-%m-%d")
-                                alldays.append(tday)
-                                alldeltas.append(deltas[np.argmax(coeffs)])
-                                allcoefs.append(np.max(coeffs))
-
-                                ###### gaussian fit ######
-                                def gauss_function(x, a, x0, sigma):
-                                    return a*np.exp(-(x-x0)**2/(2*sigma**2))
-                                x = ar(range(len(coeffs)))
-                                ymax_index = coeffs.index(np.max(coeffs))
-                                ymin = np.min(coeffs)
-                                coeffs_shift = []
-                                for i in coeffs:
-                                    i += np.absolute(ymin) # make all points above zero
-                                    coeffs_shift.append(i)
-                                n = len(coeffs)
-                                x0 = sum(x)/n
-                                sigma = (sum((x-x0)**2)/n)**0.5
-                                try:
-                                    popt, pcov = curve_fit(gauss_function, x, coeffs_shift, [ymax_index, x0, sigma])
-                                    FWHM = 2 * ((2*np.log(2))**0.5)*popt[2] # convert sigma (popt[2]) to FWHM
-                                    error = FWHM / 2  ### error is half width at full maximum
-                                except RuntimeError:
-                                    error = np.nan # gaussian fit failed
-
-                                allerrs.append(error)
-
-                        df = pd.DataFrame(np.array([alldeltas,allcoefs,allerrs]).T, index=alldays, columns=["Delta", "Coeff", "Error"],)
-                        # Include lag time window in filter folder
-                        new_filter = "%02i_" % filterid
-                        new_filter += str(int(dtt_minlag)) + "_"
-                        new_filter += str(int(dtt_minlag) + int(dtt_width))
-                        output = os.path.join('STR', new_filter, "%03i_DAYS" % mov_stack, components)
-                        if not os.path.isdir(output):
-                            os.makedirs(output)
-                        df.to_csv(os.path.join(output, "%s.csv" % ref_name), index_label="Date")
-
-        # THIS SHOULD BE IN THE API
-        updated = False
-        mappings = [{'ref': job.ref, 'flag': "D"} for job in jobs]
-        while not updated:
+    with profiler.stage("db"):
+        context = build_context(db)
+
+    # First we reset all STR (MWCS) jobs to "T"odo if the REF changed for a
+    # given pair
+    with profiler.stage("references"):
+        update_references(db, context, jobtype='MWCS')
+
+    logging.info("Stretching search: %s, in %s" % (context.search,
+                                                   context.precision))
+    logging.info("Lag time windows: %s" % ", ".join(
+        "%g-%g s" % (lag.minlag, lag.minlag + lag.width)
+        for lag in context.lag_windows))
+    logging.info("Lag sides: %s" % ", ".join(context.sides))
+    layout = cpu_layout(threads, cores, blas_threads, pin)
+    logging.info("CPU layout: %s" % describe(layout))
+
+    # Pair level work units submitted to the pool, but not finished yet
+    pending = {}
+    cache_stats = {}
+    profiles = {}
+    # Results exported to columnar tables are buffered, their jobs are only
+    # flagged as done once the tables are flushed
+    columnar = [export for export in context.exports if export != "csv"]
+    store = ColumnarStore(columnar) if columnar else None
+    written_refs = []
+    # Results are written in order by one background thread, so that the
+    # writes overlap with the computation
+    writer = ThreadPoolExecutor(max_workers=1)
+    writes = []
+
+    def write(output):
+        with profiler.stage("write"):
+            write_results(context, output, store)
+
+    def written(keep=None):
+        # Jobs of the finished writes, waiting until at most `keep` writes
+        # are left (None does not wait)
+        while writes and (writes[0][0].done() or
+                          keep is not None and len(writes) > keep):
+            future, pair, refs = writes.pop(0)
+            try:
+                with profiler.stage("wait_write"):
+                    future.result()
+            except Exception:
+                logging.exception("Writing the results failed for %s" % pair)
+                continue
+            written_refs.extend(refs)
+
+    def finish(output, refs):
+        cache_stats[output["pid"]] = output["cache"]
+        profiles[output["pid"]] = output["profile"]
+        # Keep the queue of the writer bounded
+        written(keep=2 * threads)
+        writes.append((writer.submit(write, output), output["pair"], refs))
+
+    def commit(final=False):
+        nonlocal last_report
+        if store is None or final or store.full():
+            # The tables are only flushed once all their results are in
+            written(keep=0 if store is not None or final else None)
+            if store is not None:
+                with profiler.stage("write"):
+                    store.flush()
+            if written_refs:
+                with profiler.stage("db"):
+                    complete_jobs(db, written_refs)
+                del written_refs[:]
+        if profiler.enabled and (
+                final or time.time() - last_report > report_interval):
+            write_report(profile, profiler.report(), profiles,
+                         time.time() - start)
+            last_report = time.time()
+
+    def collect(futures):
+        for future in futures:
+            pair, refs = pending.pop(future)
             try:
-                db.bulk_update_mappings(Job, mappings)
-                db.commit()
-                updated = True
-            except:
-                time.sleep(np.random.random())
-                pass
+                output = future.result()
+            except Exception:
+                logging.exception("Stretching failed for %s" % pair)
+                continue
+            finish(output, refs)
+        commit()
+
+    if threads > 1:
+        executor = ProcessPoolExecutor(max_workers=threads,
+                                       initializer=init_worker,
+                                       initargs=(context, profiler.enabled,
+                                                 layout,
+                                                 multiprocessing.Value('i')))
+    else:
+        executor = None
+        init_worker(context, profiler.enabled, layout=layout)
+
+    try:
+        # Leases of crashed runs are given back before claiming new jobs
+        with profiler.stage("db"):
+            lease_timeout = float(get_stretch_config(db, "lease_timeout"))
+            reclaim_expired(db, jobtype='MWCS', timeout=lease_timeout)
+
+        # Then we compute the jobs, claiming one batch of pairs at a time
+        leases = []
+        # The next pair and its stacks, read while the current one is computed
+        prefetched = None
+        attempt = 0
+        while True:
+            if not leases:
+                with profiler.stage("db"):
+                    leases = claim_jobs(db, jobtype='MWCS', npairs=threads)
+            if not leases:
+                with profiler.stage("db"):
+                    pending_jobs = has_pending_jobs(db, jobtype='MWCS')
+                if not pending_jobs:
+                    break
+                # All remaining pairs were claimed by somebody else meanwhile
+                with profiler.stage("wait_jobs"):
+                    backoff(attempt)
+                attempt += 1
+                continue
+            attempt = 0
+            pair, refs, days = leases.pop(0)
+
+            logging.info("There are STR (MWCS) jobs for some days to "
+                         "recompute for %s" % pair)
+
+            windows = context.pairs.get(pair)
+            if windows is None:
+                # Not a used pair anymore, but it still has jobs
+                sta1, sta2 = pair.split(':')
+                with profiler.stage("db"):
+                    station1 = get_station(db, *sta1.split("."))
+                    station2 = get_station(db, *sta2.split("."))
+                windows = pair_windows(context, station1, station2)
+            for window in windows:
+                logging.debug("Lag time window between %.2f and %.2f s" %
+                              (window.minlag, window.maxlag))
+
+            if executor is None:
+                stacks = None
+                if prefetched is not None and prefetched[0] == pair:
+                    stacks = prefetched[1]
+                if context.prefetch and not leases:
+                    with profiler.stage("db"):
+                        leases = claim_jobs(db, jobtype='MWCS', npairs=1)
+                prefetched = None
+                if context.prefetch and leases:
+                    try:
+                        prefetched = (leases[0][0], prefetch_pair(
+                            leases[0][0], leases[0][2]))
+                    except Exception:
+                        # Fails again, and is skipped, when it is its turn
+                        logging.debug("Could not read ahead %s" %
+                                      leases[0][0])
+                # Same as with the pool, a failed pair is skipped and its jobs
+                # are left leased until they expire
+                try:
+                    if stacks is None:
+                        stacks = prefetch_pair(pair, days)
+                    output = compute_pair(pair, days, windows, stacks)
+                except Exception:
+                    logging.exception("Stretching failed for %s" % pair)
+                    if stacks is not None:
+                        stacks.close()
+                    continue
+                finish(output, refs)
+                commit()
+                continue
+
+            # Keep the queue of the pool bounded
+            if len(pending) >= 2 * threads:
+                with profiler.stage("wait_workers"):
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = executor.submit(compute_pair, pair, days, windows)
+            pending[future] = (pair, refs)
+
+        if executor is not None:
+            with profiler.stage("wait_workers"):
+                done = wait(pending)[0]
+            collect(done)
+    finally:
+        # Also on errors and interruptions, so that no worker is left
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    commit(final=True)
+    writer.shutdown()
 
+    stats = {}
+    for worker_stats in cache_stats.values():
+        for key, value in worker_stats.items():
+            stats[key] = stats.get(key, 0) + value
+    if stats:
+        logging.info("Stretched REF cache: %(memory_hits)i memory hits, "
+                     "%(disk_hits)i disk hits, %(misses)i misses" % stats)
+    if profiler.enabled:
+        logging.info("Profiling report written to %s" % profile)
     logging.info('*** Finished: Compute STR ***')
 
 if __name__ == "__main__":
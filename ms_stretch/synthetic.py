@@ -0,0 +1,292 @@
+"""
+Synthetic cross-correlations with a known stretching, to check the
+numerical behaviour of the stretching computation without any data.
+
+:func:`validate_modes` runs the same synthetic days through every
+stretching mode and compares their accuracy to the exhaustive float64
+search, so that a faster mode can be accepted against an accuracy budget.
+"""
+
+import time
+
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+
+from .stretch import correlation_matrix, hierarchical_search, \
+    normalize_traces, side_traces, spline_coefficients, \
+    stretch_mat_creation, stretch_traces, tiled_correlation_matrix
+
+
+def synthetic_reference(n=6001, decay=0.25, smoothing=2., seed=0,
+                        coherence=0.):
+    """
+    Random coda-like reference trace, symmetric in amplitude around its
+    middle (zero lag) sample.
+
+    The waveforms of both sides are independent by default. Cross
+    correlations of a diffuse noise field are closer to symmetric, which
+    ``coherence`` models: the acausal side is the mirror image of the
+    causal side for 1, and a mix of it and of independent noise between 0
+    and 1.
+
+    Input:
+        :type n: int
+        :param n: Number of samples.
+
+        :type decay: float
+        :param decay: Decay time of the envelope, as a fraction of the
+        half length of the trace.
+
+        :type smoothing: float
+        :param smoothing: Width (in samples) of the gaussian smoothing of
+        the noise, which sets the dominant period of the trace.
+
+        :type seed: int
+        :param seed: Seed of the random generator.
+
+        :type coherence: float
+        :param coherence: Correlation (between 0 and 1) of the waveforms of
+        the acausal side with those of the causal side.
+
+    Output:
+        :type ref: :class:`~numpy.ndarray`
+        :param ref: 1d float64 ndarray of the trace.
+    """
+
+    rng = np.random.default_rng(seed)
+    mid = n // 2
+    lags = np.abs(np.arange(n) - mid) / float(mid)
+    noise = gaussian_filter1d(rng.standard_normal(n), smoothing)
+    if coherence:
+        k = min(mid, n - 1 - mid)
+        noise[mid - k:mid] = coherence * noise[mid + k:mid:-1] + \
+            np.sqrt(1 - coherence ** 2) * noise[mid - k:mid]
+    return noise * np.exp(-lags / decay)
+
+
+def stretched_days(ref, dvv, noise=0., seed=1):
+    """
+    Stretched copies of a reference trace, one per day.
+
+    Input:
+        :type ref: :class:`~numpy.ndarray`
+        :param ref: 1d ndarray of the reference trace.
+
+        :type dvv: :class:`~numpy.ndarray`
+        :param dvv: 1d ndarray, the relative stretching of each day. The
+        stretching computation should find ``1 + dvv`` for each day.
+
+        :type noise: float
+        :param noise: Standard deviation of the white noise added to the
+        days, relative to the standard deviation of ``ref``.
+
+        :type seed: int
+        :param seed: Seed of the random generator of the noise.
+
+    Output:
+        :type days: :class:`~numpy.ndarray`
+        :param days: 2d float64 ndarray (days x samples).
+    """
+
+    days = stretch_traces(spline_coefficients(ref),
+                          1 + np.asarray(dvv, dtype=np.float64))
+    if noise:
+        rng = np.random.default_rng(seed)
+        days += noise * np.std(ref) * rng.standard_normal(days.shape)
+    return days
+
+
+def precision_check(n=6001, ndays=50, str_range=0.01, nstr=1001,
+                    noise=0.2, seed=0):
+    """
+    Compare the float32 and float64 stretching of synthetic days.
+
+    Both the exhaustive and the hierarchical searches are run on the same
+    days, with random stretchings within ``str_range``.
+
+    Input:
+        :type n: int
+        :param n: Number of samples of the traces.
+
+        :type ndays: int
+        :param ndays: Number of days.
+
+        :type str_range: float
+        :param str_range: Amount of the desired stretching (one side).
+
+        :type nstr: int
+        :param nstr: Number of stretching steps of the exhaustive search.
+
+        :type noise: float
+        :param noise: Relative noise level of the days, see
+        :func:`stretched_days`.
+
+        :type seed: int
+        :param seed: Seed of the random generators.
+
+    Output:
+        :type report: dict
+        :param report: The stretching ``step``, and per search the largest
+        difference between the float32 and float64 stretchings
+        (``<search>_delta``), their coefficients (``<search>_coeff``) and
+        the largest error of either precision with respect to the true
+        stretching (``<search>_error_float32``/``_float64``). The memory
+        of the stretched reference in both precisions is reported as
+        ``bytes_float32``/``bytes_float64``.
+    """
+
+    rng = np.random.default_rng(seed)
+    dvv = rng.uniform(-0.8 * str_range, 0.8 * str_range, ndays)
+    ref = synthetic_reference(n, seed=seed)
+    days = stretched_days(ref, dvv, noise=noise, seed=seed + 1)
+    deltas = 1 + np.linspace(-str_range, str_range, nstr)
+
+    report = {"step": 2 * str_range / (nstr - 1)}
+    found = {}
+    for dtype in (np.float64, np.float32):
+        name = np.dtype(dtype).name
+        ref_norm = normalize_traces(stretch_mat_creation(
+            ref, str_range=str_range, nstr=nstr, dtype=dtype)[0],
+            dtype=dtype)
+        report["bytes_" + name] = ref_norm.nbytes
+        coeffs = correlation_matrix(days, ref_norm)
+        imax = np.argmax(coeffs, axis=1)
+        found["exhaustive", name] = (deltas[imax],
+                                     coeffs[np.arange(ndays), imax])
+        found["hierarchical", name] = hierarchical_search(
+            days, ref, str_range=str_range, dtype=dtype)[2:]
+
+    for search in ("exhaustive", "hierarchical"):
+        d64, c64 = found[search, "float64"]
+        d32, c32 = found[search, "float32"]
+        report[search + "_delta"] = float(np.max(np.abs(d32 - d64)))
+        report[search + "_coeff"] = float(np.max(np.abs(c32 - c64)))
+        for name, d in (("float64", d64), ("float32", d32)):
+            report["%s_error_%s" % (search, name)] = \
+                float(np.max(np.abs(d - 1 - dvv)))
+    return report
+
+
+def _exhaustive(days, ref, str_range, nstr, dtype=np.float64, center=None):
+    ref_norm = normalize_traces(stretch_mat_creation(
+        ref, str_range=str_range, nstr=nstr, center=center, dtype=dtype)[0],
+        dtype=dtype)
+    coeffs = correlation_matrix(days, ref_norm)
+    deltas = 1 + np.linspace(-str_range, str_range, nstr)
+    return deltas[np.argmax(coeffs, axis=1)]
+
+
+def _tiled(days, ref, str_range, nstr):
+    # A small budget, to really go through several tiles
+    coeffs = tiled_correlation_matrix(days, ref, str_range=str_range,
+                                      nstr=nstr, budget=16 * 1024 ** 2)
+    deltas = 1 + np.linspace(-str_range, str_range, nstr)
+    return deltas[np.argmax(coeffs, axis=1)]
+
+
+def _symmetric(days, ref, str_range, nstr):
+    mid = len(ref) // 2
+    folded_ref, center = side_traces(ref, mid, "symmetric")
+    return _exhaustive(side_traces(days, mid, "symmetric")[0], folded_ref,
+                       str_range, nstr, center=center)
+
+
+# Stretching modes of the validation, as functions of
+# (days, ref, str_range, nstr) returning the stretching of every day
+STRETCH_MODES = {
+    "exhaustive": _exhaustive,
+    "exhaustive_float32":
+        lambda days, ref, str_range, nstr: _exhaustive(
+            days, ref, str_range, nstr, dtype=np.float32),
+    "tiled": _tiled,
+    "hierarchical":
+        lambda days, ref, str_range, nstr: hierarchical_search(
+            days, ref, str_range=str_range)[2],
+    "hierarchical_float32":
+        lambda days, ref, str_range, nstr: hierarchical_search(
+            days, ref, str_range=str_range, dtype=np.float32)[2],
+    "symmetric": _symmetric,
+}
+
+def validate_modes(n=6001, ndays=100, noise_levels=(0., 0.2, 0.5),
+                   str_range=0.01, nstr=1001, budget=None, modes=None,
+                   seed=0, coherence=1.):
+    """
+    Accuracy and runtime of the stretching modes on synthetic days with a
+    known stretching.
+
+    For every noise level, the same days (random stretchings within 80 %
+    of ``str_range``) go through every mode. A mode is accepted if its
+    bias and its RMS error are both within ``budget`` of those of the
+    exhaustive float64 search, which is the reference.
+
+    Input:
+        :type n: int
+        :param n: Number of samples of the traces.
+
+        :type ndays: int
+        :param ndays: Number of days per noise level.
+
+        :type noise_levels: list of float
+        :param noise_levels: Relative noise levels of the days, see
+        :func:`stretched_days`.
+
+        :type str_range: float
+        :param str_range: Amount of the desired stretching (one side).
+
+        :type nstr: int
+        :param nstr: Number of stretching steps of the exhaustive modes.
+
+        :type budget: float
+        :param budget: Accepted degradation of the bias and of the RMS
+        error, in stretching units. Half a step of the exhaustive search
+        by default.
+
+        :type modes: list of str
+        :param modes: Names of :data:`STRETCH_MODES` to validate, all by
+        default. The exhaustive search always runs as the reference.
+
+        :type seed: int
+        :param seed: Seed of the random generators.
+
+        :type coherence: float
+        :param coherence: Coherence of the two sides of the reference, see
+        :func:`synthetic_reference`. The symmetric mode only averages
+        signal, rather than independent waveforms, on coherent sides.
+
+    Output:
+        :type rows: list of dict
+        :param rows: One row per mode and noise level, with the ``mode``,
+        the ``noise``, the ``bias`` and ``rms`` of the found stretchings
+        minus the true ones, the ``runtime`` (s) and whether the mode is
+        ``accepted``.
+    """
+
+    if budget is None:
+        budget = str_range / (nstr - 1)
+    if modes is None:
+        modes = list(STRETCH_MODES)
+    modes = ["exhaustive"] + [mode for mode in modes if mode != "exhaustive"]
+
+    rng = np.random.default_rng(seed)
+    ref = synthetic_reference(n, seed=seed, coherence=coherence)
+    rows = []
+    for k, noise in enumerate(noise_levels):
+        dvv = rng.uniform(-0.8 * str_range, 0.8 * str_range, ndays)
+        days = stretched_days(ref, dvv, noise=noise, seed=seed + k + 1)
+        for mode in modes:
+            start = time.perf_counter()
+            found = STRETCH_MODES[mode](days, ref, str_range, nstr)
+            runtime = time.perf_counter() - start
+            errors = found - 1 - dvv
+            row = {"mode": mode, "noise": noise,
+                   "bias": float(np.mean(errors)),
+                   "rms": float(np.sqrt(np.mean(errors ** 2))),
+                   "runtime": runtime}
+            if mode == "exhaustive":
+                reference = row
+            row["accepted"] = bool(
+                abs(row["bias"] - reference["bias"]) <= budget and
+                row["rms"] - reference["rms"] <= budget)
+            rows.append(row)
+    return rows
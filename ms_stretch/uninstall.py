@@ -1,11 +1,14 @@
 """Drop default stations table in database.
 
 Deletes Default Stations entry in the current database. Normally
-the entry should also disappear in the admin viewer."""
+the entry should also disappear in the admin viewer. The configuration
+table of the stretching computation and the registry of the REF
+fingerprints are dropped as well."""
 
 from msnoise.api import *
 
-from .default_table_def import DefaultStations
+from .default_table_def import DefaultStations, RefFingerprint, \
+    StretchConfig
 
 def main():
     # TODO: Test if Session is actually needed
@@ -14,3 +17,5 @@ def main():
     session = Session()
 
     DefaultStations.__table__.drop(engine)
+    StretchConfig.__table__.drop(engine, checkfirst=True)
+    RefFingerprint.__table__.drop(engine, checkfirst=True)
@@ -10,9 +10,11 @@ setup(
     entry_points = {
         'msnoise.plugins.table_def': [
             'DefaultStations = ms_stretch.default_table_def:DefaultStations',
+            'StretchConfig = ms_stretch.default_table_def:StretchConfig',
             ],
         'msnoise.plugins.admin_view': [
             'DefaultStationsView = ms_stretch.plugin_definition:DefaultStationsView',
+            'StretchConfigView = ms_stretch.plugin_definition:StretchConfigView',
             ],
         'msnoise.plugins.commands': [
             'stretch = ms_stretch.plugin_definition:stretch',